@@ -1,5 +1,8 @@
+import logging
 import streamlit as st                                                                                                                                                                        
-from pages import dashboard_page, explore_page, group_management_page, login_page, my_posts_page, signup_page
+from metrics import start_metrics_server
+from reencrypt_jobs import start_job_resumer
+from pages import clear_session_caches, dashboard_page, explore_page, group_management_page, login_page, my_posts_page, signup_page
 
 # Remove menu and footer
 # =======================
@@ -12,6 +15,17 @@ hide_streamlit_style = """
 st.markdown(hide_streamlit_style, unsafe_allow_html=True) 
 # =======================
 
+# Page render timings go to the log as JSON lines; /metrics is served when METRICS_PORT is set
+metrics_logger = logging.getLogger('metrics')
+if not metrics_logger.handlers:
+    metrics_logger.addHandler(logging.StreamHandler())
+    metrics_logger.setLevel(logging.INFO)
+start_metrics_server()
+
+# Picks up re-encryption jobs left queued or interrupted by a restart; the first check
+# runs one lease interval from now, off the startup path
+start_job_resumer()
+
 
 def main():
     st.sidebar.title("Navigation")
@@ -28,6 +42,7 @@ def main():
             my_posts_page(st.session_state['current_user']['uid'])
         elif page == "Logout":
             del st.session_state['current_user']
+            clear_session_caches()  # Feeds and unwrapped keys must not outlive the login
             st.experimental_rerun()
     else:
         page = st.sidebar.radio("Go to", ("Login", "Sign Up"))
@@ -0,0 +1,167 @@
+# Concurrent Firestore fan-out on the async client.
+# Feed and membership code often needs many independent round trips: one 'in' query per
+# slice of 30 authors, document reads for every member, one commit per 500 writes. The
+# coroutines here issue them together, bounded by FANOUT_CONCURRENCY, so the wait is
+# roughly the slowest round trip instead of the sum of them.
+#
+# Streamlit runs pages in ordinary threads, so run_sync submits each fan-out to one
+# long-lived event loop on a background thread and blocks for the result; the sync
+# helpers in firestore_batch are the facade the rest of the app calls.
+# A single loop matters: the async client's gRPC channel is bound to the loop it was first
+# used on. With STORAGE_BACKEND=memory the in-memory client is adapted to the same interface.
+import asyncio
+import os
+import threading
+import time
+from storage import STORAGE_BACKEND, get_backend_client, get_client
+
+# Maximum number of Firestore calls in flight for one fan-out
+FANOUT_CONCURRENCY = int(os.getenv('FANOUT_CONCURRENCY', 16))
+
+
+class _MemoryAsyncQuery:
+    def __init__(self, query):
+        self._query = query
+
+    def where(self, *args, **kwargs):
+        return _MemoryAsyncQuery(self._query.where(*args, **kwargs))
+
+    def order_by(self, *args, **kwargs):
+        return _MemoryAsyncQuery(self._query.order_by(*args, **kwargs))
+
+    def limit(self, *args, **kwargs):
+        return _MemoryAsyncQuery(self._query.limit(*args, **kwargs))
+
+    def start_after(self, *args, **kwargs):
+        return _MemoryAsyncQuery(self._query.start_after(*args, **kwargs))
+
+    async def get(self):
+        return self._query.get()
+
+
+class _MemoryAsyncBatch:
+    def __init__(self, batch):
+        self._batch = batch
+
+    def update(self, doc_ref, data):
+        self._batch.update(doc_ref, data)
+
+    def set(self, doc_ref, data, merge=False):
+        self._batch.set(doc_ref, data, merge=merge)
+
+    def delete(self, doc_ref):
+        self._batch.delete(doc_ref)
+
+    async def commit(self):
+        return self._batch.commit()
+
+
+class MemoryAsyncClient:
+    # The subset of the async client used here, over the in-memory store's data
+
+    def __init__(self, client):
+        self._client = client
+
+    def collection(self, name):
+        return _MemoryAsyncQuery(self._client.collection(name))
+
+    def document(self, path):
+        collection_name, document_id = path.split('/', 1)
+        return self._client.collection(collection_name).document(document_id)
+
+    async def get_all(self, references):
+        for snapshot in self._client.get_all(references):
+            yield snapshot
+
+    def batch(self):
+        return _MemoryAsyncBatch(self._client.batch())
+
+
+_loop = None
+_async_client = None
+_loop_lock = threading.Lock()
+
+
+def _get_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name='firestore-async', daemon=True).start()
+        return _loop
+
+
+def _get_async_client():
+    # Only called on the loop thread, so no lock is needed
+    global _async_client
+    if _async_client is None:
+        if STORAGE_BACKEND == 'memory':
+            _async_client = MemoryAsyncClient(get_backend_client())
+        else:
+            get_client()  # Initialises the Firebase app the async client authenticates with
+            from firebase_admin import firestore_async
+            _async_client = firestore_async.client()
+    return _async_client
+
+
+async def gather_bounded(coroutines, limit=FANOUT_CONCURRENCY):
+    # Like asyncio.gather, with at most `limit` coroutines running at once; results keep their order
+    semaphore = asyncio.Semaphore(limit)
+
+    async def bounded(coroutine):
+        async with semaphore:
+            return await coroutine
+    return await asyncio.gather(*(bounded(coroutine) for coroutine in coroutines))
+
+
+async def run_queries_async(collection, field, value_slices, build_query=None):
+    # One 'in' query per slice, all in flight together; returns one result list per slice
+    client = _get_async_client()
+
+    async def run_slice(value_slice):
+        query = client.collection(collection).where(field, 'in', value_slice)
+        if build_query is not None:
+            query = build_query(query)
+        return await query.get()
+    return await gather_bounded(run_slice(value_slice) for value_slice in value_slices)
+
+
+async def get_documents_async(collection, id_chunks):
+    # One get_all per chunk of ids, all in flight together; returns the snapshots in order
+    client = _get_async_client()
+
+    async def read_chunk(ids):
+        references = [client.document(f"{collection}/{document_id}") for document_id in ids]
+        return [snapshot async for snapshot in client.get_all(references)]
+    chunks = await gather_bounded(read_chunk(ids) for ids in id_chunks)
+    return [snapshot for chunk in chunks for snapshot in chunk]
+
+
+async def commit_batch_async(writes):
+    # writes: (kind, document path, data) with kind 'update', 'set', 'merge' or 'delete'.
+    # Returns the commit latency.
+    client = _get_async_client()
+    batch = client.batch()
+    for kind, path, data in writes:
+        doc_ref = client.document(path)
+        if kind == 'delete':
+            batch.delete(doc_ref)
+        elif kind == 'merge':
+            batch.set(doc_ref, data, merge=True)
+        elif kind == 'set':
+            batch.set(doc_ref, data)
+        else:
+            batch.update(doc_ref, data)
+    start = time.perf_counter()
+    await batch.commit()
+    return time.perf_counter() - start
+
+
+def submit(coroutine):
+    # Schedule a coroutine on the shared loop; returns a concurrent.futures.Future
+    return asyncio.run_coroutine_threadsafe(coroutine, _get_loop())
+
+
+def run_sync(coroutine):
+    # Sync facade: run a fan-out on the shared loop and wait for its result
+    return submit(coroutine).result()
@@ -0,0 +1,179 @@
+# Encrypted post attachments (images, video, other files).
+# Attachments are read from a file-like object and encrypted in fixed-size chunks through a
+# generator pipeline, so memory use stays at about one chunk whatever the file size. Each
+# chunk is sealed with AES-GCM under a key derived from the post's data key, so anyone who
+# can read the post can read its attachments and nobody else can. The chunk index and a
+# last-chunk flag are authenticated with every chunk, which stops chunks being reordered,
+# swapped between attachments or dropped from the end.
+#
+# Encrypted chunks go to a chunk store picked by ATTACHMENT_STORE: 'local' (the default)
+# writes one file per attachment under ATTACHMENT_DIR; 'firebase' writes one Cloud Storage
+# object per chunk to the project's default bucket. Posts only keep the metadata dict
+# returned by encrypt_attachment.
+import base64
+import os
+import struct
+import threading
+import uuid
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from metrics import timed
+
+ATTACHMENT_CHUNK_SIZE = int(os.getenv('ATTACHMENT_CHUNK_SIZE', 64 * 1024))
+ATTACHMENT_STORE = os.getenv('ATTACHMENT_STORE', 'local')
+ATTACHMENT_DIR = os.getenv('ATTACHMENT_DIR', 'attachments')
+
+# AES-GCM tag appended to every chunk
+CHUNK_OVERHEAD = 16
+
+_CHUNK_AAD = struct.Struct('>QB')
+
+
+def attachment_key(data_key, attachment_id):
+    # A separate key per attachment, so chunk nonces can simply be the chunk index
+    return HKDF(algorithm=hashes.SHA256(), length=32, salt=attachment_id.encode(), info=b'post attachment v1') \
+        .derive(base64.urlsafe_b64decode(data_key))
+
+
+def _chunk_nonce(index):
+    return index.to_bytes(12, 'big')
+
+
+def read_chunks(fileobj, chunk_size=ATTACHMENT_CHUNK_SIZE):
+    # Yields full chunks (only the last may be short); an empty file yields one empty chunk
+    chunk = fileobj.read(chunk_size)
+    while True:
+        # Short reads are allowed from pipes and sockets, so top the chunk up before yielding
+        while len(chunk) < chunk_size:
+            more = fileobj.read(chunk_size - len(chunk))
+            if not more:
+                break
+            chunk += more
+        following = fileobj.read(chunk_size) if len(chunk) == chunk_size else b''
+        yield chunk, not following
+        if not following:
+            return
+        chunk = following
+
+
+def encrypt_chunks(chunks, key):
+    # chunks: (plaintext, is_last) pairs as produced by read_chunks
+    aesgcm = AESGCM(key)
+    for index, (chunk, is_last) in enumerate(chunks):
+        yield aesgcm.encrypt(_chunk_nonce(index), chunk, _CHUNK_AAD.pack(index, is_last))
+
+
+def decrypt_chunk(key, index, encrypted_chunk, is_last):
+    return AESGCM(key).decrypt(_chunk_nonce(index), bytes(encrypted_chunk), _CHUNK_AAD.pack(index, is_last))
+
+
+class LocalChunkStore:
+    # One file per attachment. Every encrypted chunk except the last is exactly
+    # chunk_size + CHUNK_OVERHEAD bytes, so chunk i is found with a single seek.
+
+    def __init__(self, root=ATTACHMENT_DIR):
+        self.root = root
+
+    def _path(self, attachment_id):
+        return os.path.join(self.root, f"{attachment_id}.bin")
+
+    def write(self, attachment_id, encrypted_chunks):
+        os.makedirs(self.root, exist_ok=True)
+        count = 0
+        with open(self._path(attachment_id), 'wb') as f:
+            for encrypted_chunk in encrypted_chunks:
+                f.write(encrypted_chunk)
+                count += 1
+        return count
+
+    def read(self, attachment_id, index, chunk_size):
+        record_size = chunk_size + CHUNK_OVERHEAD
+        with open(self._path(attachment_id), 'rb') as f:
+            f.seek(index * record_size)
+            return f.read(record_size)
+
+    def delete(self, attachment_id):
+        try:
+            os.remove(self._path(attachment_id))
+        except FileNotFoundError:
+            pass
+
+
+class FirebaseChunkStore:
+    # One Cloud Storage object per encrypted chunk, under attachments/{id}/
+
+    def __init__(self, bucket_name=None):
+        from firebase_admin import storage
+        self.bucket = storage.bucket(bucket_name)
+
+    def _blob_name(self, attachment_id, index):
+        return f"attachments/{attachment_id}/{index:08d}"
+
+    def write(self, attachment_id, encrypted_chunks):
+        count = 0
+        for index, encrypted_chunk in enumerate(encrypted_chunks):
+            self.bucket.blob(self._blob_name(attachment_id, index)).upload_from_string(
+                encrypted_chunk, content_type='application/octet-stream'
+            )
+            count += 1
+        return count
+
+    def read(self, attachment_id, index, chunk_size):
+        return self.bucket.blob(self._blob_name(attachment_id, index)).download_as_bytes()
+
+    def delete(self, attachment_id):
+        for blob in self.bucket.list_blobs(prefix=f"attachments/{attachment_id}/"):
+            blob.delete()
+
+
+_chunk_store = None
+_chunk_store_lock = threading.Lock()
+
+
+def get_chunk_store():
+    global _chunk_store
+    with _chunk_store_lock:
+        if _chunk_store is None:
+            if ATTACHMENT_STORE == 'local':
+                _chunk_store = LocalChunkStore()
+            elif ATTACHMENT_STORE == 'firebase':
+                _chunk_store = FirebaseChunkStore()
+            else:
+                raise ValueError(f"Unknown ATTACHMENT_STORE: {ATTACHMENT_STORE!r} (expected 'local' or 'firebase')")
+        return _chunk_store
+
+
+@timed('crypto.encrypt_attachment')
+def encrypt_attachment(fileobj, data_key, content_type=None, store=None, chunk_size=ATTACHMENT_CHUNK_SIZE):
+    # Streams fileobj into the chunk store and returns the metadata kept on the post
+    store = store or get_chunk_store()
+    attachment_id = uuid.uuid4().hex
+    size = 0
+
+    def counted(chunks):
+        nonlocal size
+        for chunk, is_last in chunks:
+            size += len(chunk)
+            yield chunk, is_last
+
+    chunks = encrypt_chunks(counted(read_chunks(fileobj, chunk_size)), attachment_key(data_key, attachment_id))
+    count = store.write(attachment_id, chunks)
+    return {'id': attachment_id, 'type': content_type, 'size': size, 'chunk_size': chunk_size, 'chunks': count}
+
+
+def iter_attachment(attachment, data_key, start=0, end=None, store=None):
+    # Yields the plaintext of bytes [start, end) a chunk at a time, reading only the chunks that overlap it
+    store = store or get_chunk_store()
+    end = attachment['size'] if end is None else min(end, attachment['size'])
+    chunk_size = attachment['chunk_size']
+    key = attachment_key(data_key, attachment['id'])
+    for index in range(start // chunk_size, (end + chunk_size - 1) // chunk_size):
+        encrypted_chunk = store.read(attachment['id'], index, chunk_size)
+        chunk = decrypt_chunk(key, index, encrypted_chunk, index == attachment['chunks'] - 1)
+        chunk_start = index * chunk_size
+        yield chunk[max(0, start - chunk_start):end - chunk_start]
+
+
+def delete_attachment(attachment, store=None):
+    (store or get_chunk_store()).delete(attachment['id'])
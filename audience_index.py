@@ -0,0 +1,89 @@
+# Denormalised audience index: one 'audiences' document per user listing everyone who
+# shares a group with them, so the feed, post creation and key lookups cost one document
+# read instead of an array_contains query over 'groups' plus client-side unions.
+#
+#   audiences/{user_id}: {'groups': {group_id: [member ids]}, 'members': [user ids]}
+#
+# 'members' is the union of the per-group lists and always includes the user. Keeping the
+# per-group lists lets a removal drop only the people the user no longer shares any group
+# with. Group membership only changes through create_group_document and
+# update_group_members, which write the group's member list and every affected audience
+# document in one transaction, so the index can't drift from the groups.
+# Users whose audience document predates the index get it built from their groups on first read.
+from storage import db, firestore
+
+AUDIENCE_COLLECTION = 'audiences'
+
+
+def _audience_document(user_id, groups):
+    members = {user_id}
+    for group_members in groups.values():
+        members.update(group_members)
+    return {'groups': groups, 'members': sorted(members)}
+
+
+def _groups_of(user_id, transaction):
+    # The slow path the index replaces, used only to build a missing audience document
+    groups = db.collection('groups').where('members', 'array_contains', user_id).get(transaction=transaction)
+    return {group.id: list(group.to_dict().get('members', [])) for group in groups}
+
+
+def _build_audience(transaction, user_id):
+    audience_ref = db.collection(AUDIENCE_COLLECTION).document(user_id)
+    snapshot = audience_ref.get(transaction=transaction)
+    if snapshot.exists:
+        return snapshot.to_dict()  # Another session built it first
+    audience = _audience_document(user_id, _groups_of(user_id, transaction))
+    transaction.set(audience_ref, audience)
+    return audience
+
+
+def read_audience(user_id):
+    # The user's audience document: {'groups': {group_id: [member ids]}, 'members': [user ids]}
+    snapshot = db.collection(AUDIENCE_COLLECTION).document(user_id).get()
+    if snapshot.exists:
+        return snapshot.to_dict()
+    return firestore.transactional(_build_audience)(db.transaction(), user_id)
+
+
+def _commit_membership(transaction, group_ref, add, remove, new_group):
+    # Reads come first, as Firestore transactions require: the group (unless it is being
+    # created) and the audience documents of everyone whose audience changes
+    if new_group is None:
+        previous = group_ref.get(transaction=transaction).to_dict().get('members', [])
+    else:
+        previous = []
+    members = [member for member in previous if member not in remove]
+    members += [member for member in dict.fromkeys(add) if member not in members]
+
+    audiences_ref = db.collection(AUDIENCE_COLLECTION)
+    affected = sorted(set(previous) | set(members))
+    current_groups = {}
+    for snapshot in db.get_all([audiences_ref.document(user_id) for user_id in affected], transaction=transaction):
+        current_groups[snapshot.id] = snapshot.to_dict()['groups'] if snapshot.exists else _groups_of(snapshot.id, transaction)
+
+    if new_group is None:
+        transaction.update(group_ref, {'members': members})
+    else:
+        transaction.create(group_ref, dict(new_group, members=members))
+    for user_id in affected:
+        groups = dict(current_groups.get(user_id, {}))
+        if user_id in members:
+            groups[group_ref.id] = members
+        else:
+            groups.pop(group_ref.id, None)
+        transaction.set(audiences_ref.document(user_id), _audience_document(user_id, groups))
+    return members
+
+
+def create_group_document(group_data, members):
+    # Create a group with these members and add it to their audiences; returns the group id
+    group_ref = db.collection('groups').document()
+    firestore.transactional(_commit_membership)(db.transaction(), group_ref, members, (), group_data)
+    return group_ref.id
+
+
+def update_group_members(group_id, add=(), remove=()):
+    # Add and remove group members and update every affected audience; returns the new member list
+    group_ref = db.collection('groups').document(group_id)
+    return firestore.transactional(_commit_membership)(db.transaction(), group_ref, add, remove, None)
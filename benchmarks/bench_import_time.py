@@ -0,0 +1,82 @@
+# Import-time profile of the app's cold start: what it costs to import everything the
+# unauthenticated login page needs, measured in fresh interpreters like a new container.
+#
+# Run from the repository root:
+#   python benchmarks/bench_import_time.py              # profile `import pages`
+#   python benchmarks/bench_import_time.py --module app --top 40
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _run(module, extra_args=()):
+    # Default to the production backend: with deferred initialisation no credentials are needed to import
+    env = dict(os.environ, STORAGE_BACKEND=os.environ.get("STORAGE_BACKEND", "firestore"))
+    return subprocess.run(
+        [sys.executable, *extra_args, "-c", f"import {module}"],
+        cwd=ROOT, env=env, capture_output=True, text=True, check=True,
+    )
+
+
+def cold_import_seconds(module):
+    # Wall-clock time of a fresh interpreter importing `module`
+    start = time.perf_counter()
+    _run(module)
+    return time.perf_counter() - start
+
+
+def import_profile(module):
+    # Parses `python -X importtime` output into (self µs, cumulative µs, depth, name) rows
+    rows = []
+    for line in _run(module, ("-X", "importtime")).stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        rows.append((int(self_us), int(cumulative_us), depth, name.strip()))
+    return rows
+
+
+def module_rows(rows, module):
+    # Rows are printed children first, so the module's own imports are the rows just before
+    # its depth-0 line, back to the previous depth-0 line (interpreter startup is left out)
+    end = max(index for index, row in enumerate(rows) if row[2] == 0 and row[3] == module)
+    start = end
+    while start > 0 and rows[start - 1][2] > 0:
+        start -= 1
+    return rows[start:end + 1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import-time profile of the app's cold start")
+    parser.add_argument("--module", default="pages", help="module to import (default: pages)")
+    parser.add_argument("--top", type=int, default=25, help="number of slowest imports to list")
+    parser.add_argument("--runs", type=int, default=5, help="fresh interpreters to time")
+    args = parser.parse_args()
+
+    rows = module_rows(import_profile(args.module), args.module)
+    total = rows[-1][1]
+    print(f"import {args.module}: {total / 1000:.1f} ms across {len(rows)} modules "
+          f"(STORAGE_BACKEND={os.environ.get('STORAGE_BACKEND', 'firestore')})")
+
+    # Top-level project and third-party imports first: that's where deferring an import pays off
+    print(f"\n{'cumulative ms':>14} {'self ms':>9}  module (imported directly)")
+    for self_us, cumulative_us, _, name in sorted((row for row in rows if row[2] == 1), key=lambda row: -row[1])[:args.top]:
+        print(f"{cumulative_us / 1000:>14.1f} {self_us / 1000:>9.1f}  {name}")
+
+    print(f"\n{'self ms':>14}  slowest modules anywhere in the tree")
+    for self_us, _, _, name in sorted(rows, key=lambda row: -row[0])[:args.top]:
+        print(f"{self_us / 1000:>14.1f}  {name}")
+
+    samples = [cold_import_seconds(args.module) for _ in range(args.runs)]
+    print(f"\ncold start (interpreter + import {args.module}): median {statistics.median(samples) * 1000:.0f} ms "
+          f"over {args.runs} runs")
+
+
+if __name__ == "__main__":
+    main()
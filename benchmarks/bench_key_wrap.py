@@ -0,0 +1,75 @@
+# Compares serial, thread-pool and process-pool key wrapping in encrypt_for_group_members,
+# then the RSA-OAEP and X25519 key-wrap schemes.
+# Run from the repository root: python benchmarks/bench_key_wrap.py
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+os.environ["STORAGE_BACKEND"] = "memory"
+os.environ.setdefault("KEYSTORE_PASSPHRASE", "benchmark")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tempfile
+from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PublicKey
+from encrypt_decrypt import encrypt_for_group_members, unwrap_symmetric_key, wrap_symmetric_key
+from gen_keys import generate_ec_identity, generate_key_pair
+from group_utils import load_public_key_from_certificate
+
+AUDIENCE_SIZES = [10, 100, 1000]
+DISTINCT_KEYS = 16  # RSA public operations cost the same for any key, so a few are reused
+REPEATS = 3
+MESSAGE = "benchmark post " * 20
+
+
+def make_audience(size, keys):
+    return {f"member{i}": keys[i % len(keys)] for i in range(size)}
+
+
+def best_time(fn):
+    timings = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def compare_schemes(iterations=200):
+    # Per-member wrap/unwrap cost and blob size for RSA-OAEP vs X25519
+    cwd = os.getcwd()
+    os.chdir(tempfile.mkdtemp(prefix="bench-wrap-"))
+    try:
+        rsa_public = load_public_key_from_certificate(generate_key_pair("bench"))
+        x25519_public = X25519PublicKey.from_public_bytes(generate_ec_identity("bench")["x25519_public_key"])
+        symmetric_key = Fernet.generate_key()
+        print(f"{'scheme':>8} {'wrap':>10} {'unwrap':>10} {'bytes':>6}")
+        for name, public_key in (("rsa-oaep", rsa_public), ("x25519", x25519_public)):
+            wrapped = wrap_symmetric_key(public_key, symmetric_key)
+            wrap = best_time(lambda: [wrap_symmetric_key(public_key, symmetric_key) for _ in range(iterations)]) / iterations
+            unwrap = best_time(lambda: [unwrap_symmetric_key(wrapped, "bench") for _ in range(iterations)]) / iterations
+            print(f"{name:>8} {wrap * 1e6:>8.1f}us {unwrap * 1e6:>8.1f}us {len(wrapped):>6}")
+    finally:
+        os.chdir(cwd)
+
+
+def main():
+    keys = [rsa.generate_private_key(public_exponent=65537, key_size=2048).public_key() for _ in range(DISTINCT_KEYS)]
+    workers = os.cpu_count()
+    print(f"{'members':>8} {'serial':>10} {'threads':>10} {'processes':>10} {'thread x':>9} {'process x':>9}")
+    with ThreadPoolExecutor(max_workers=workers) as threads, ProcessPoolExecutor(max_workers=workers) as processes:
+        for size in AUDIENCE_SIZES:
+            audience = make_audience(size, keys)
+            serial = best_time(lambda: encrypt_for_group_members(audience, MESSAGE))
+            threaded = best_time(lambda: encrypt_for_group_members(audience, MESSAGE, threads, parallel_threshold=0))
+            multiproc = best_time(lambda: encrypt_for_group_members(audience, MESSAGE, processes, parallel_threshold=0))
+            print(f"{size:>8} {serial * 1000:>8.1f}ms {threaded * 1000:>8.1f}ms {multiproc * 1000:>8.1f}ms "
+                  f"{serial / threaded:>8.2f}x {serial / multiproc:>8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
+    print()
+    compare_schemes()
@@ -0,0 +1,235 @@
+# Offline benchmark suite for the crypto and membership hot paths.
+# Runs against the in-memory storage backend, so no Firebase project or network is needed.
+#
+# Run from the repository root:
+#   python benchmarks/run_benchmarks.py                          # print results
+#   python benchmarks/run_benchmarks.py --save baseline.json     # store a baseline
+#   python benchmarks/run_benchmarks.py --compare baseline.json  # flag regressions (exit code 1)
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+os.environ["STORAGE_BACKEND"] = "memory"
+os.environ.setdefault("KEYSTORE_PASSPHRASE", "benchmark")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import streamlit as st
+from bench_import_time import cold_import_seconds
+from encrypt_decrypt import decrypt_message_with_private_key, encrypt_for_group_members, load_private_key, seal_envelope, store_private_key
+from gen_keys import generate_key_pair
+from group_utils import add_user_to_group, create_group, get_group_member_public_keys, get_group_posts, remove_user_from_group
+from post_utils import create_post
+from reencrypt_jobs import list_jobs
+from storage import db
+
+DEFAULT_AUDIENCES = [10, 100]
+DEFAULT_POST_COUNTS = [50]
+DISTINCT_KEY_PAIRS = 8  # Members share a few real key pairs so setup doesn't spend minutes generating RSA keys
+MESSAGE = "benchmark post " * 20
+
+
+def percentile(sorted_samples, fraction):
+    # Nearest-rank percentile
+    index = max(0, min(len(sorted_samples) - 1, round(fraction * len(sorted_samples)) - 1))
+    return sorted_samples[index]
+
+
+def summarise(samples):
+    samples = sorted(samples)
+    total = sum(samples)
+    return {
+        "iterations": len(samples),
+        "ops_per_sec": len(samples) / total if total else float("inf"),
+        "p50_ms": percentile(samples, 0.50) * 1000,
+        "p95_ms": percentile(samples, 0.95) * 1000,
+        "p99_ms": percentile(samples, 0.99) * 1000,
+    }
+
+
+def measure(fn, iterations):
+    samples = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        fn(i)
+        samples.append(time.perf_counter() - start)
+    return summarise(samples)
+
+
+class Fixture:
+    # Seeds users, one group and its posts into the in-memory store
+
+    def __init__(self, key_pairs):
+        self.key_pairs = key_pairs  # [(private key, certificate PEM)]
+        self.user_count = 0
+
+    def reset(self):
+        db.reset()
+        st.session_state.clear()
+        self.user_count = 0
+
+    def add_user(self):
+        uid = f"user{self.user_count}"
+        private_key, certificate = self.key_pairs[self.user_count % len(self.key_pairs)]
+        self.user_count += 1
+        store_private_key(uid, private_key)
+        db.collection("users").document(uid).set({"username": uid, "email": f"{uid}@example.com", "certificate": certificate})
+        return uid
+
+    def build_group(self, audience, post_count):
+        self.reset()
+        admin = self.add_user()
+        create_group("bench", admin)
+        members = [admin]
+        for _ in range(audience - 1):
+            uid = self.add_user()
+            add_user_to_group("bench", uid, admin)
+            wait_for_jobs(admin)
+            members.append(uid)
+        for i in range(post_count):
+            author = members[i % len(members)]
+            st.session_state.clear()  # Each author posts from their own session
+            create_post(author, MESSAGE)
+        st.session_state.clear()
+        return admin, members
+
+
+def wait_for_jobs(admin_id):
+    # Membership changes re-encrypt posts in background jobs; block until the admin's have finished
+    while any(job['status'] in ('queued', 'running') for job in list_jobs(admin_id, limit=100)):
+        time.sleep(0.005)
+
+
+def make_key_pairs(count):
+    key_pairs = []
+    for i in range(count):
+        certificate = generate_key_pair(f"seed{i}")
+        key_pairs.append((load_private_key(f"seed{i}"), certificate))
+    return key_pairs
+
+
+def run(audiences, post_counts, iterations):
+    results = {}
+
+    def record(name, params, stats):
+        label = name + "[" + ",".join(f"{k}={v}" for k, v in params.items()) + "]"
+        results[label] = dict(stats, **params)
+        print(f"{label:<55} {stats['ops_per_sec']:>9.1f} ops/s  p50 {stats['p50_ms']:>8.2f} ms  "
+              f"p95 {stats['p95_ms']:>8.2f} ms  p99 {stats['p99_ms']:>8.2f} ms")
+
+    record("cold_import", {"module": "pages"}, measure(lambda i: cold_import_seconds("pages"), max(3, iterations // 5)))
+    record("generate_key_pair", {}, measure(lambda i: generate_key_pair(f"keygen{i}"), max(3, iterations // 5)))
+    fixture = Fixture(make_key_pairs(DISTINCT_KEY_PAIRS))
+
+    for audience in audiences:
+        for post_count in post_counts:
+            params = {"audience": audience, "posts": post_count}
+            admin, members = fixture.build_group(audience, post_count)
+            public_keys = get_group_member_public_keys(admin)
+
+            record("encrypt_for_group_members", params,
+                   measure(lambda i: encrypt_for_group_members(public_keys, MESSAGE), iterations))
+
+            encrypted_msg, encrypted_keys = encrypt_for_group_members(public_keys, MESSAGE)
+            record("decrypt_message_with_private_key", params,
+                   measure(lambda i: decrypt_message_with_private_key(encrypted_msg, encrypted_keys[admin], admin), iterations))
+
+            record("seal_envelope", params,
+                   measure(lambda i: seal_envelope(MESSAGE, member_public_keys=public_keys), iterations))
+
+            record("create_post", params, measure(lambda i: create_post(admin, MESSAGE), iterations))
+
+            reader = members[-1]
+            record("get_group_posts", params, measure(lambda i: get_group_posts(reader), iterations))
+
+            # Membership changes alternate on one spare user so every add has a matching remove
+            spare = fixture.add_user()
+            # The *_user_to_group timings are what the admin waits for; *_job adds the background re-encryption
+            add_samples, remove_samples, add_job_samples, remove_job_samples = [], [], [], []
+            for _ in range(max(1, iterations // 5)):
+                start = time.perf_counter()
+                add_user_to_group("bench", spare, admin)
+                add_samples.append(time.perf_counter() - start)
+                wait_for_jobs(admin)
+                add_job_samples.append(time.perf_counter() - start)
+                start = time.perf_counter()
+                remove_user_from_group("bench", spare, admin)
+                remove_samples.append(time.perf_counter() - start)
+                wait_for_jobs(admin)
+                remove_job_samples.append(time.perf_counter() - start)
+            record("add_user_to_group", params, summarise(add_samples))
+            record("add_user_to_group_job", params, summarise(add_job_samples))
+            record("remove_user_from_group", params, summarise(remove_samples))
+            record("remove_user_from_group_job", params, summarise(remove_job_samples))
+
+    return results
+
+
+def compare(results, baseline, threshold):
+    # A benchmark regresses when its p50 grows by more than `threshold` over the baseline
+    regressions = []
+    for label, stats in results.items():
+        previous = baseline.get("results", {}).get(label)
+        if previous is None:
+            continue
+        change = stats["p50_ms"] / previous["p50_ms"] - 1 if previous["p50_ms"] else 0.0
+        marker = "REGRESSION" if change > threshold else "ok"
+        print(f"{label:<55} p50 {previous['p50_ms']:>8.2f} -> {stats['p50_ms']:>8.2f} ms ({change:+.0%}) {marker}")
+        if change > threshold:
+            regressions.append(label)
+    return regressions
+
+
+def parse_sizes(value):
+    return [int(size) for size in value.split(",") if size]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks for crypto and membership operations")
+    parser.add_argument("--audiences", type=parse_sizes, default=DEFAULT_AUDIENCES, help="comma-separated group sizes")
+    parser.add_argument("--posts", type=parse_sizes, default=DEFAULT_POST_COUNTS, help="comma-separated post counts")
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--save", help="write results to this JSON baseline file")
+    parser.add_argument("--compare", help="compare against this JSON baseline file")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed p50 slowdown before flagging (0.2 = 20%%)")
+    args = parser.parse_args()
+
+    logging.getLogger("streamlit").setLevel(logging.ERROR)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    save_path = os.path.abspath(args.save) if args.save else None
+
+    # The keystore is written to ./keys, so work in a scratch directory
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        results = run(args.audiences, args.posts, args.iterations)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if save_path:
+        with open(save_path, "w") as f:
+            json.dump({
+                "meta": {"python": platform.python_version(), "machine": platform.machine(), "created": time.time()},
+                "results": results,
+            }, f, indent=2)
+        print(f"Saved baseline to {save_path}")
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} benchmark(s) regressed")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,62 @@
+import base64
+import hashlib
+import os
+import struct
+from collections import namedtuple
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.asymmetric import rsa, padding
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey, X25519PublicKey
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives import hashes
 from cryptography.fernet import Fernet
+from keystore import get_keystore, key_entry_name
+from metrics import timed
 
+# Audiences smaller than this are wrapped serially; pool overhead isn't worth it
+PARALLEL_WRAP_THRESHOLD = 64
 
-def load_private_key(name):
-    with open(f'keys/{name}_private_key.pem', 'rb') as key_file:
+# Key-wrap scheme for new wraps: 'rsa-oaep' (RSA-2048 OAEP, 256-byte blobs) or
+# 'x25519' (X25519 ECDH + HKDF-SHA256 + AES-GCM, 81-byte blobs). Members without an
+# X25519 key always fall back to RSA, and unwrapping handles both. Each wrap identifies
+# its own scheme (see is_x25519_wrap), so posts don't record which one was used.
+KEY_WRAP_SCHEME = os.getenv('KEY_WRAP_SCHEME', 'rsa-oaep')
+
+# X25519 wraps are tagged with this leading version byte; RSA-OAEP blobs are bare
+X25519_WRAP_VERSION = 1
+# version byte | ephemeral public key (32) | AES-GCM of the 32-byte post key (32 + 16-byte tag)
+X25519_WRAP_SIZE = 1 + 32 + 32 + 16
+_X25519_HKDF_INFO = b'social-media-encryption key wrap v1'
+
+# Maximum number of parsed private keys kept in memory
+PRIVATE_KEY_CACHE_SIZE = 128
+
+# (uid, kind) -> (signature of where it was read from, private key), most recently used last
+_private_key_cache = OrderedDict()
+_private_key_cache_lock = threading.Lock()
+_private_key_cache_stats = {'hits': 0, 'misses': 0}
+
+
+def private_key_path(name, kind='rsa'):
+    # Per-user PEM files: used when no keystore is configured, and read for keys
+    # migrate_keystore.py hasn't imported yet
+    if kind == 'rsa':
+        return f'keys/{name}_private_key.pem'
+    return f'keys/{name}_{kind}_private_key.pem'
+
+
+def _key_file_signature(path):
+    # mtime + inode change whenever the file is rewritten
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_ino, stat.st_size)
+
+
+def _read_private_key(path):
+    with open(path, 'rb') as key_file:
         private_key = serialization.load_pem_private_key(
             key_file.read(),
             password=None,  # No password
@@ -15,33 +65,387 @@ def load_private_key(name):
     return private_key
 
 
-def encrypt_for_group_members(group_public_keys, message):
+@timed('crypto.load_private_key')
+def load_private_key(name, kind='rsa'):
+    # Keys live in the keystore; storing a key again appends a new record, so its offset
+    # tells a cached key from a replaced one without touching the filesystem
+    keystore = get_keystore()
+    entry_name = key_entry_name(name, kind)
+    offset = keystore.locate(entry_name) if keystore is not None else None
+    if offset is not None:
+        signature = ('keystore', offset)
+    else:
+        path = private_key_path(name, kind)
+        signature = ('pem',) + _key_file_signature(path)
+    cache_key = (name, kind)
+
+    with _private_key_cache_lock:
+        cached = _private_key_cache.get(cache_key)
+        if cached is not None and cached[0] == signature:
+            _private_key_cache.move_to_end(cache_key)
+            _private_key_cache_stats['hits'] += 1
+            return cached[1]
+        _private_key_cache_stats['misses'] += 1
+
+    # Decrypt and parse outside the lock so other users' lookups are not blocked
+    if offset is not None:
+        private_key = serialization.load_der_private_key(
+            keystore.read_at(offset, entry_name), password=None, backend=default_backend()
+        )
+    else:
+        private_key = _read_private_key(path)
+
+    with _private_key_cache_lock:
+        _private_key_cache[cache_key] = (signature, private_key)
+        _private_key_cache.move_to_end(cache_key)
+        while len(_private_key_cache) > PRIVATE_KEY_CACHE_SIZE:
+            _private_key_cache.popitem(last=False)
+    return private_key
+
+
+def store_private_key(name, private_key, kind='rsa'):
+    # Add (or replace) a user's private key in the keystore, where it is encrypted at rest,
+    # or in its PEM file when no keystore is configured
+    keystore = get_keystore()
+    if keystore is not None:
+        keystore.put(key_entry_name(name, kind), private_key.private_bytes(
+            encoding=serialization.Encoding.DER,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.NoEncryption()
+        ))
+    else:
+        path = private_key_path(name, kind)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(private_key.private_bytes(
+                encoding=serialization.Encoding.PEM,
+                format=serialization.PrivateFormat.PKCS8,
+                encryption_algorithm=serialization.NoEncryption()
+            ))
+    invalidate_private_key(name)
+
+
+def invalidate_private_key(name=None):
+    # Drop one user's cached keys, or every cached key if no name is given
+    with _private_key_cache_lock:
+        if name is None:
+            _private_key_cache.clear()
+        else:
+            for cache_key in [key for key in _private_key_cache if key[0] == name]:
+                del _private_key_cache[cache_key]
+
+
+def get_private_key_cache_stats():
+    with _private_key_cache_lock:
+        return {
+            'hits': _private_key_cache_stats['hits'],
+            'misses': _private_key_cache_stats['misses'],
+            'size': len(_private_key_cache),
+            'max_size': PRIVATE_KEY_CACHE_SIZE,
+        }
+
+
+def _oaep_padding():
+    return padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()), algorithm=hashes.SHA256(), label=None)
+
+
+def _x25519_wrapping_key(shared_secret, ephemeral_public, recipient_public):
+    return HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=ephemeral_public + recipient_public,
+        info=_X25519_HKDF_INFO,
+    ).derive(shared_secret)
+
+
+def _raw_public_bytes(public_key):
+    return public_key.public_bytes(encoding=serialization.Encoding.Raw, format=serialization.PublicFormat.Raw)
+
+
+def _wrap_x25519(public_key, symmetric_key):
+    # Fresh ephemeral key per wrap, so the derived AES key is single-use and a fixed nonce is safe
+    ephemeral_key = X25519PrivateKey.generate()
+    ephemeral_public = _raw_public_bytes(ephemeral_key.public_key())
+    wrapping_key = _x25519_wrapping_key(
+        ephemeral_key.exchange(public_key), ephemeral_public, _raw_public_bytes(public_key)
+    )
+    # Fernet keys are base64 text; wrapping the 32 raw bytes keeps the blob small
+    ciphertext = AESGCM(wrapping_key).encrypt(bytes(12), base64.urlsafe_b64decode(symmetric_key), None)
+    return bytes([X25519_WRAP_VERSION]) + ephemeral_public + ciphertext
+
+
+def _unwrap_x25519(encrypted_key, user_id):
+    private_key = load_private_key(user_id, 'x25519')
+    ephemeral_public = encrypted_key[1:33]
+    wrapping_key = _x25519_wrapping_key(
+        private_key.exchange(X25519PublicKey.from_public_bytes(ephemeral_public)),
+        ephemeral_public,
+        _raw_public_bytes(private_key.public_key())
+    )
+    raw_key = AESGCM(wrapping_key).decrypt(bytes(12), encrypted_key[33:], None)
+    return base64.urlsafe_b64encode(raw_key)
+
+
+def is_x25519_wrap(encrypted_key):
+    # X25519 wraps have one exact size and start with the version byte; RSA-OAEP blobs are the
+    # modulus size (256 bytes for RSA-2048) and can start with any byte
+    return len(encrypted_key) == X25519_WRAP_SIZE and encrypted_key[:1] == bytes([X25519_WRAP_VERSION])
+
+
+@timed('crypto.wrap_symmetric_key')
+def wrap_symmetric_key(public_key, symmetric_key):
+    # Encrypt a post's symmetric key for a single member; the scheme follows the key type
+    if isinstance(public_key, X25519PublicKey):
+        return _wrap_x25519(public_key, symmetric_key)
+    return public_key.encrypt(symmetric_key, _oaep_padding())
+
+
+@timed('crypto.unwrap_symmetric_key')
+def unwrap_symmetric_key(encrypted_key, user_id):
+    # Decrypt a post's symmetric key with the user's private key (cached after the first load)
+    if is_x25519_wrap(encrypted_key):
+        return _unwrap_x25519(encrypted_key, user_id)
+    private_key = load_private_key(user_id)
+    return private_key.decrypt(encrypted_key, _oaep_padding())
+
+
+def _wrap_chunk(chunk, symmetric_key):
+    return [(member_id, wrap_symmetric_key(public_key, symmetric_key)) for member_id, public_key in chunk]
+
+
+def _wrap_der_chunk(chunk, symmetric_key):
+    # Runs in a worker process: key objects can't be pickled, so they travel as DER
+    return [
+        (member_id, wrap_symmetric_key(serialization.load_der_public_key(public_der), symmetric_key))
+        for member_id, public_der in chunk
+    ]
+
+
+@timed('crypto.wrap_key_for_members')
+def wrap_key_for_members(group_public_keys, symmetric_key, executor=None, parallel_threshold=PARALLEL_WRAP_THRESHOLD):
+    # Encrypt the symmetric key with each member's public key, optionally spread over an executor.
+    # The backend releases the GIL during RSA, so a ThreadPoolExecutor already uses every core;
+    # a ProcessPoolExecutor is worth it only for very large fan-outs.
+    members = list(group_public_keys.items())
+    if executor is None or len(members) < parallel_threshold:
+        return dict(_wrap_chunk(members, symmetric_key))
+
+    worker = _wrap_chunk
+    if isinstance(executor, ProcessPoolExecutor):
+        worker = _wrap_der_chunk
+        members = [
+            (member_id, public_key.public_bytes(
+                encoding=serialization.Encoding.DER,
+                format=serialization.PublicFormat.SubjectPublicKeyInfo
+            ))
+            for member_id, public_key in members
+        ]
+
+    # A few chunks per worker keeps the pool busy without paying per-member task overhead
+    chunk_count = max(1, (os.cpu_count() or 1) * 4)
+    chunk_size = max(1, -(-len(members) // chunk_count))
+    futures = [
+        executor.submit(worker, members[i:i + chunk_size], symmetric_key)
+        for i in range(0, len(members), chunk_size)
+    ]
+
+    encrypted_keys = {}
+    for future in futures:
+        encrypted_keys.update(future.result())
+    return encrypted_keys
+
+
+_wrap_executor = None
+_wrap_executor_lock = threading.Lock()
+
+
+def get_wrap_executor():
+    # Shared thread pool for key wrapping, created on first use
+    global _wrap_executor
+    with _wrap_executor_lock:
+        if _wrap_executor is None:
+            _wrap_executor = ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix='key-wrap')
+        return _wrap_executor
+
+
+@timed('crypto.encrypt_for_group_members')
+def encrypt_for_group_members(group_public_keys, message, executor=None, parallel_threshold=PARALLEL_WRAP_THRESHOLD):
     # Generate a symmetric key for the message
     symmetric_key = Fernet.generate_key()
     fernet = Fernet(symmetric_key)
     encrypted_message = fernet.encrypt(message.encode())
 
     # Encrypt the symmetric key with each group member's public key
-    encrypted_keys = {}
-    for member_id, public_key in group_public_keys.items():
-        encrypted_key = public_key.encrypt(
-            symmetric_key,
-            padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()), algorithm=hashes.SHA256(), label=None)
-        )
-        encrypted_keys[member_id] = encrypted_key
+    encrypted_keys = wrap_key_for_members(group_public_keys, symmetric_key, executor, parallel_threshold)
 
     return encrypted_message, encrypted_keys
 
+def generate_group_key():
+    # Group epoch keys are plain Fernet keys, wrapped with RSA once per member
+    return Fernet.generate_key()
+
+
 def decrypt_message_with_private_key(encrypted_message, encrypted_key, user_id):
+    # Envelope posts carry the wrapped key inside, so encrypted_key may be None for them
+    if is_envelope(encrypted_message):
+        envelope = open_envelope(encrypted_message)
+        symmetric_key = unwrap_envelope_for_member(envelope, user_id)
+        if symmetric_key is None:
+            raise KeyError(f"No key for {user_id} in this post")
+        return decrypt_envelope(envelope, symmetric_key)
+
     # Decrypt the symmetric key with the private key
-    private_key = load_private_key(user_id)
-    symmetric_key = private_key.decrypt(
-        encrypted_key,
-        padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()), algorithm=hashes.SHA256(), label=None)
-    )
+    symmetric_key = unwrap_symmetric_key(encrypted_key, user_id)
 
     # Decrypt the message with the symmetric key
+    return decrypt_with_symmetric_key(encrypted_message, symmetric_key)
+
+
+@timed('crypto.decrypt_with_symmetric_key')
+def decrypt_with_symmetric_key(encrypted_message, symmetric_key):
     fernet = Fernet(symmetric_key)
-    decrypted_message = fernet.decrypt(encrypted_message).decode()
+    return fernet.decrypt(encrypted_message).decode()
+
+
+# Compact binary post envelope (version 1), stored as raw bytes:
+#   magic (1) | version (1) | nonce (12) | entry count (2) | entries | AES-GCM ciphertext + tag
+# Each entry is  kind (1) | key id (8) | [epoch (4), group entries only] | length (2) | wrapped key
+# Key ids are the first 8 bytes of SHA-256 of the member uid or group id. Member entries hold
+# the data key wrapped with wrap_symmetric_key; group entries hold it under the group epoch key.
+ENVELOPE_MAGIC = 0xE5
+ENVELOPE_VERSION = 1
+ENTRY_MEMBER = 0
+ENTRY_GROUP = 1
+KEY_ID_SIZE = 8
+
+_ENVELOPE_HEADER = struct.Struct('>BB12sH')
+_ENTRY_HEADER = struct.Struct(f'>B{KEY_ID_SIZE}s')
+_EPOCH = struct.Struct('>I')
+_LENGTH = struct.Struct('>H')
+
+# Parsed envelope; entries and ciphertext are memoryviews into the stored bytes
+Envelope = namedtuple('Envelope', ['nonce', 'member_entries', 'group_entries', 'ciphertext', 'raw'])
+
+
+def key_id(identifier):
+    return hashlib.sha256(identifier.encode()).digest()[:KEY_ID_SIZE]
+
+
+def is_envelope(value):
+    # Legacy Fernet tokens are base64 text and never start with the magic byte
+    return isinstance(value, (bytes, bytearray, memoryview)) and len(value) > 1 \
+        and value[0] == ENVELOPE_MAGIC and value[1] == ENVELOPE_VERSION
+
+
+def _group_wrapping_key(group_key):
+    # Derive a dedicated AES key so the group key isn't used directly under two constructions
+    return HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=b'envelope group wrap v1') \
+        .derive(base64.urlsafe_b64decode(group_key))
+
+
+def _pack_entries(entries):
+    # entries: [(kind, key_id, epoch or None, wrapped)]
+    packed = []
+    for kind, entry_key_id, epoch, wrapped in entries:
+        packed.append(_ENTRY_HEADER.pack(kind, entry_key_id))
+        if kind == ENTRY_GROUP:
+            packed.append(_EPOCH.pack(epoch))
+        packed.append(_LENGTH.pack(len(wrapped)))
+        packed.append(bytes(wrapped))
+    return packed
+
+
+@timed('crypto.seal_envelope')
+def seal_envelope(message, member_public_keys=None, group_epoch_keys=None, executor=None, data_key=None):
+    # member_public_keys: {uid: public key}; group_epoch_keys: {group_id: (epoch, group_key)}.
+    # data_key is passed in when other data (attachments) is keyed off the same post key.
+    if data_key is None:
+        data_key = Fernet.generate_key()  # urlsafe base64 of 32 random bytes, as the wrap functions expect
+    nonce = os.urandom(12)
+    ciphertext = AESGCM(base64.urlsafe_b64decode(data_key)).encrypt(
+        nonce, message.encode(), bytes([ENVELOPE_MAGIC, ENVELOPE_VERSION])
+    )
+
+    entries = []
+    for member_id, wrapped in wrap_key_for_members(member_public_keys or {}, data_key, executor).items():
+        entries.append((ENTRY_MEMBER, key_id(member_id), None, wrapped))
+    for group_id, (epoch, group_key) in (group_epoch_keys or {}).items():
+        group_nonce = os.urandom(12)
+        wrapped = group_nonce + AESGCM(_group_wrapping_key(group_key)).encrypt(
+            group_nonce, base64.urlsafe_b64decode(data_key), None
+        )
+        entries.append((ENTRY_GROUP, key_id(group_id), epoch, wrapped))
+
+    header = _ENVELOPE_HEADER.pack(ENVELOPE_MAGIC, ENVELOPE_VERSION, nonce, len(entries))
+    return b''.join([header] + _pack_entries(entries) + [ciphertext])
+
+
+def open_envelope(envelope):
+    # Parse without copying: every slice is a memoryview into the stored bytes
+    view = memoryview(envelope)
+    magic, version, nonce, count = _ENVELOPE_HEADER.unpack_from(view, 0)
+    if magic != ENVELOPE_MAGIC or version != ENVELOPE_VERSION:
+        raise ValueError("Not a version 1 post envelope")
+
+    offset = _ENVELOPE_HEADER.size
+    member_entries = {}
+    group_entries = {}
+    for _ in range(count):
+        kind, entry_key_id = _ENTRY_HEADER.unpack_from(view, offset)
+        offset += _ENTRY_HEADER.size
+        epoch = None
+        if kind == ENTRY_GROUP:
+            (epoch,) = _EPOCH.unpack_from(view, offset)
+            offset += _EPOCH.size
+        (length,) = _LENGTH.unpack_from(view, offset)
+        offset += _LENGTH.size
+        wrapped = view[offset:offset + length]
+        offset += length
+        if kind == ENTRY_GROUP:
+            group_entries[entry_key_id] = (epoch, wrapped)
+        else:
+            member_entries[entry_key_id] = wrapped
+
+    return Envelope(nonce, member_entries, group_entries, view[offset:], view)
+
+
+def unwrap_envelope_for_member(envelope, user_id):
+    wrapped = envelope.member_entries.get(key_id(user_id))
+    if wrapped is None:
+        return None
+    return unwrap_symmetric_key(bytes(wrapped), user_id)
+
+
+@timed('crypto.unwrap_envelope_for_group')
+def unwrap_envelope_for_group(envelope, group_id, group_key):
+    # Returns the data key, or None if the envelope has no entry for this group
+    entry = envelope.group_entries.get(key_id(group_id))
+    if entry is None:
+        return None
+    wrapped = entry[1]
+    raw_key = AESGCM(_group_wrapping_key(group_key)).decrypt(wrapped[:12], wrapped[12:], None)
+    return base64.urlsafe_b64encode(raw_key)
+
+
+@timed('crypto.decrypt_envelope')
+def decrypt_envelope(envelope, data_key):
+    if not isinstance(envelope, Envelope):
+        envelope = open_envelope(envelope)
+    return AESGCM(base64.urlsafe_b64decode(data_key)).decrypt(
+        envelope.nonce, envelope.ciphertext, bytes([ENVELOPE_MAGIC, ENVELOPE_VERSION])
+    ).decode()
+
+
+@timed('crypto.add_member_entries')
+def add_member_entries(envelope, wrapped_keys):
+    # New envelope bytes with extra member entries ({uid: wrapped key}); the ciphertext is reused as-is
+    parsed = open_envelope(envelope)
+    added = {key_id(member_id): wrapped for member_id, wrapped in wrapped_keys.items()}
+    entries = [(ENTRY_MEMBER, bytes(entry_key_id), None, wrapped)
+               for entry_key_id, wrapped in parsed.member_entries.items() if entry_key_id not in added]
+    entries += [(ENTRY_MEMBER, entry_key_id, None, wrapped) for entry_key_id, wrapped in added.items()]
+    entries += [(ENTRY_GROUP, bytes(entry_key_id), epoch, wrapped)
+                for entry_key_id, (epoch, wrapped) in parsed.group_entries.items()]
 
-    return decrypted_message
+    header = _ENVELOPE_HEADER.pack(ENVELOPE_MAGIC, ENVELOPE_VERSION, parsed.nonce, len(entries))
+    return b''.join([header] + _pack_entries(entries) + [parsed.ciphertext])
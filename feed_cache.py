@@ -0,0 +1,40 @@
+# Generation counters for cached feeds, shared by every session in this process.
+# Cached feed reads include the relevant generations in their cache key, and every
+# write bumps the generations it affects, so a write is seen on the next rerun while
+# reruns with no writes in between are served without touching Firestore.
+#   user generation:  that user's group feed, own posts, groups and explore exclusions
+#   posts generation: every explore feed (any new or deleted post may show up there)
+import os
+import threading
+
+# Cached feeds are also dropped after this many seconds, to pick up writes made by other processes
+FEED_CACHE_TTL = int(os.getenv('FEED_CACHE_TTL', 60))
+
+_user_generations = {}
+_posts_generation = 0
+_generation_lock = threading.Lock()
+
+
+def user_generation(user_id):
+    with _generation_lock:
+        return _user_generations.get(user_id, 0)
+
+
+def posts_generation():
+    with _generation_lock:
+        return _posts_generation
+
+
+def invalidate_users(user_ids):
+    with _generation_lock:
+        for user_id in set(user_ids):
+            _user_generations[user_id] = _user_generations.get(user_id, 0) + 1
+
+
+def invalidate_posts(audience_ids):
+    # A post was written or deleted: its author's and readers' feeds and every explore feed change
+    global _posts_generation
+    with _generation_lock:
+        _posts_generation += 1
+        for user_id in set(audience_ids):
+            _user_generations[user_id] = _user_generations.get(user_id, 0) + 1
@@ -0,0 +1,153 @@
+# Live group feed kept up to date by Firestore snapshot listeners.
+# One listener watches the groups the user belongs to; whenever the audience (everyone
+# sharing a group with the user) changes, the post listeners are re-registered over it in
+# 'in' slices. Each post listener watches the newest `window` posts of its slice and applies
+# only the changed documents, so keeping the feed fresh costs reads per change instead of a
+# re-query of the whole feed on every rerun. Callbacks arrive on the client's background
+# thread, so state is guarded by a lock and pages read a merged copy with page().
+#
+# Streamlit never says when a session ends (the tab is just closed), so every open listener
+# is kept in a process-wide registry and one whose page() hasn't been called for
+# FEED_LISTENER_IDLE_SECONDS is closed by a background sweep. A page that finds its session's
+# listener closed starts a new one.
+import functools
+import logging
+import os
+import threading
+import time
+from firestore_batch import IN_QUERY_LIMIT, chunked, merge_sorted, newest_first, post_sort_key, snapshot_to_post, split_page
+from group_utils import FEED_PAGE_SIZE
+from metrics import register_gauges
+from storage import db
+
+logger = logging.getLogger(__name__)
+
+# Listeners unused for this long are closed, checked every FEED_LISTENER_SWEEP_SECONDS
+FEED_LISTENER_IDLE_SECONDS = int(os.getenv('FEED_LISTENER_IDLE_SECONDS', 15 * 60))
+FEED_LISTENER_SWEEP_SECONDS = int(os.getenv('FEED_LISTENER_SWEEP_SECONDS', 60))
+
+_listeners = set()
+_listeners_lock = threading.Lock()
+_sweeper = None
+
+
+class FeedListener:
+    def __init__(self, user_id, window=FEED_PAGE_SIZE):
+        self.user_id = user_id
+        self.window = window
+        self.version = 0  # Bumped whenever the feed changes
+        self._lock = threading.Lock()
+        self._audience = None
+        self._audience_generation = 0
+        self._slices = {}  # slice index -> {post_id: post}
+        self._expected_slices = 0
+        self._post_watches = []
+        self._closed = False
+        self._ready = threading.Event()  # Set once every slice has delivered its first snapshot
+        self.last_used = time.monotonic()
+        _register(self)
+        groups_query = db.collection('groups').where('members', 'array_contains', user_id)
+        self._groups_watch = groups_query.on_snapshot(self._on_groups)
+
+    def _on_groups(self, snapshots, changes, read_time):
+        audience = set()
+        for snapshot in snapshots:
+            audience.update(snapshot.to_dict().get('members', []))
+        audience.discard(self.user_id)  # Own posts aren't shown in the group feed
+
+        with self._lock:
+            if self._closed or audience == self._audience:
+                return  # e.g. an epoch rotation touched the group but not its members
+            self._audience = audience
+            self._audience_generation += 1
+            generation = self._audience_generation
+            stale_watches, self._post_watches = self._post_watches, []
+            self._slices = {}
+            self._expected_slices = len(chunked(audience, IN_QUERY_LIMIT))
+            self.version += 1
+            if not audience:
+                self._ready.set()
+        for watch in stale_watches:
+            watch.unsubscribe()
+
+        posts_ref = db.collection('posts')
+        for index, user_ids in enumerate(chunked(sorted(audience), IN_QUERY_LIMIT)):
+            query = newest_first(posts_ref.where('user_id', 'in', user_ids), self.window)
+            watch = query.on_snapshot(functools.partial(self._on_posts, generation, index))
+            with self._lock:
+                if self._closed or generation != self._audience_generation:
+                    watch.unsubscribe()  # Superseded while registering
+                    return
+                self._post_watches.append(watch)
+
+    def _on_posts(self, generation, index, snapshots, changes, read_time):
+        with self._lock:
+            if generation != self._audience_generation:
+                return  # Delivered by a watch over an old audience
+            posts = self._slices.setdefault(index, {})
+            for change in changes:
+                if change.type.name == 'REMOVED':
+                    posts.pop(change.document.id, None)
+                else:
+                    posts[change.document.id] = snapshot_to_post(change.document)
+            self.version += 1
+            if len(self._slices) == self._expected_slices:
+                self._ready.set()
+
+    def page(self, timeout=10):
+        # The newest `window` posts and a cursor for reading older ones, as get_group_posts returns.
+        # The first call waits for the initial snapshots.
+        self.last_used = time.monotonic()
+        self._ready.wait(timeout)
+        with self._lock:
+            slices = [sorted(posts.values(), key=post_sort_key, reverse=True) for posts in self._slices.values()]
+        posts = merge_sorted(slices, key=post_sort_key, limit=self.window + 1, reverse=True)
+        return split_page(posts, self.window)
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            watches, self._post_watches = self._post_watches, []
+        with _listeners_lock:
+            _listeners.discard(self)
+        self._groups_watch.unsubscribe()
+        for watch in watches:
+            watch.unsubscribe()
+
+
+def _register(listener):
+    global _sweeper
+    with _listeners_lock:
+        _listeners.add(listener)
+        if _sweeper is None:
+            _sweeper = threading.Thread(target=_sweep, name='feed-listener-sweeper', daemon=True)
+            _sweeper.start()
+            # Open listeners show up on /metrics as app_feed_listeners_open
+            register_gauges('feed_listeners', lambda: {'open': len(_listeners)})
+
+
+def close_idle_listeners(max_idle=FEED_LISTENER_IDLE_SECONDS):
+    # Close listeners whose page() hasn't been called for max_idle seconds; returns how many
+    cutoff = time.monotonic() - max_idle
+    with _listeners_lock:
+        idle = [listener for listener in _listeners if listener.last_used < cutoff]
+    for listener in idle:
+        listener.close()
+    return len(idle)
+
+
+def _sweep():
+    while True:
+        time.sleep(FEED_LISTENER_SWEEP_SECONDS)
+        try:
+            closed = close_idle_listeners()
+            if closed:
+                logger.info("Closed %d idle feed listeners", closed)
+        except Exception:
+            logger.exception("Closing idle feed listeners failed")
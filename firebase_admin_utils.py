@@ -1,21 +1,56 @@
 import os
+import threading
+import time
 from dotenv import load_dotenv
-import requests
 import streamlit as st
-import firebase_admin
-from firebase_admin import credentials, auth, firestore
-from gen_keys import generate_key_pair
+from firestore_batch import get_documents
+from storage import db
 
-# Initialize Firebase Admin once
-if not firebase_admin._apps:
-    cred = credentials.Certificate('firebase-admin.json')
-    default_app = firebase_admin.initialize_app(cred)
+# firebase_admin, requests and the key generation modules are imported where they are
+# used: none of them is needed to render the login page, and together they take longer
+# to import than the rest of the app
+
+# uid -> (expiry time, username), shared by every session in this process
+USERNAME_CACHE_TTL = 300
+_username_cache = {}
+_username_cache_lock = threading.Lock()
+
+
+def remember_usernames(usernames):
+    # Warm the cache with usernames read elsewhere (e.g. alongside certificates)
+    expiry = time.monotonic() + USERNAME_CACHE_TTL
+    with _username_cache_lock:
+        for uid, username in usernames.items():
+            _username_cache[uid] = (expiry, username)
+
+
+def get_usernames(user_ids):
+    # Resolve uid -> username for a page of posts with at most one batched read
+    now = time.monotonic()
+    usernames = {}
+    missing = []
+    with _username_cache_lock:
+        for uid in set(user_ids):
+            cached = _username_cache.get(uid)
+            if cached is not None and cached[0] > now:
+                usernames[uid] = cached[1]
+            else:
+                missing.append(uid)
+
+    if missing:
+        fetched = {}
+        for user_doc in get_documents('users', missing):
+            if user_doc.exists:
+                fetched[user_doc.id] = user_doc.to_dict().get('username')
+        remember_usernames(fetched)
+        usernames.update(fetched)
+
+    return usernames
 
-# Firestore database
-db = firestore.client()
 
 # Function to create a new user in Firebase Authentication
 def create_user(email, password):
+    from firebase_admin import auth
     try:
         user = auth.create_user(email=email, password=password)
         return user
@@ -25,14 +60,20 @@ def create_user(email, password):
     
 # Function to save user details in Firestore
 def save_user_details(user_id, username, email):
+    from gen_keys import generate_ec_identity
+    from key_pool import issue_key_pair
     try:
-        certificate = generate_key_pair(user_id)
+        # Takes a pre-generated key from the pool; only the certificate is issued here
+        certificate = issue_key_pair(user_id)
+        ec_public_keys = generate_ec_identity(user_id)
         doc_ref = db.collection(u'users').document(user_id)
         doc_ref.set({
             u'username': username,
             u'email': email,
-            u'certificate': certificate
+            u'certificate': certificate,
+            **ec_public_keys
         })
+        remember_usernames({user_id: username})
         return True
     except Exception as e:
         st.error(f"Error saving user details: {str(e)}")
@@ -40,6 +81,7 @@ def save_user_details(user_id, username, email):
     
 
 def authenticate_user(email, password):
+    import requests
     load_dotenv()
     api_key = os.getenv("FIREBASE_KEY")
     url = f"https://identitytoolkit.googleapis.com/v1/accounts:signInWithPassword?key={api_key}"
@@ -0,0 +1,222 @@
+import base64
+import datetime
+import heapq
+import json
+import logging
+import time
+from async_store import FANOUT_CONCURRENCY, commit_batch_async, get_documents_async, run_queries_async, run_sync, submit
+from metrics import count_reads, count_writes, observe
+from storage import firestore
+
+logger = logging.getLogger(__name__)
+
+# Firestore caps an 'in' filter at 30 values and a write batch at 500 operations
+IN_QUERY_LIMIT = 30
+BATCH_WRITE_LIMIT = 500
+
+# Document ids read per get_all call
+GET_ALL_CHUNK = 100
+
+
+def chunked(values, size):
+    values = list(values)
+    return [values[i:i + size] for i in range(0, len(values), size)]
+
+
+def query_where_in_slices(collection, field, values, build_query=None):
+    # Split an 'in' filter on `collection` into legal slices and run them concurrently on
+    # the async client, returning one result list per slice. build_query can add
+    # ordering/limits to each slice.
+    slices = chunked(values, IN_QUERY_LIMIT)
+    if not slices:
+        return []
+    operation = f'firestore.{collection}.query'
+    start = time.perf_counter()
+    results = run_sync(run_queries_async(collection, field, slices, build_query))
+    observe(operation, time.perf_counter() - start)
+    # Firestore bills a query that matches nothing as one read
+    count_reads(operation, sum(max(1, len(result)) for result in results))
+    return results
+
+
+def stream_where_in(collection, field, values, build_query=None):
+    # Same as query_where_in_slices, flattened into one list of snapshots
+    return [snapshot for result in query_where_in_slices(collection, field, values, build_query) for snapshot in result]
+
+
+def get_documents(collection, ids):
+    # Read documents by id, GET_ALL_CHUNK per get_all call with the calls run concurrently.
+    # Missing documents come back as snapshots with exists == False.
+    id_chunks = chunked(dict.fromkeys(ids), GET_ALL_CHUNK)
+    if not id_chunks:
+        return []
+    operation = f'firestore.{collection}.get_all'
+    start = time.perf_counter()
+    snapshots = run_sync(get_documents_async(collection, id_chunks))
+    observe(operation, time.perf_counter() - start)
+    count_reads(operation, len(snapshots))
+    return snapshots
+
+
+def _encode_cursor_value(value):
+    if isinstance(value, datetime.datetime):
+        return {'ts': value.isoformat()}
+    return value
+
+
+def _decode_cursor_value(value):
+    if isinstance(value, dict) and 'ts' in value:
+        return datetime.datetime.fromisoformat(value['ts'])
+    return value
+
+
+def encode_cursor(values):
+    # Opaque page cursor handed to the UI; values are the last document's order-by values
+    payload = json.dumps([_encode_cursor_value(value) for value in values])
+    return base64.urlsafe_b64encode(payload.encode()).decode()
+
+
+def decode_cursor(cursor):
+    if not cursor:
+        return None
+    return [_decode_cursor_value(value) for value in json.loads(base64.urlsafe_b64decode(cursor.encode()))]
+
+
+def newest_first(query, page_size, cursor=None):
+    # Order posts newest first (document id breaks ties), resume after the cursor
+    # and read one extra document to learn whether another page exists.
+    # Filtered by user_id this needs the composite index in firestore.indexes.json;
+    # unfiltered (Explore) the automatic single-field timestamp index serves it.
+    query = query.order_by('timestamp', direction=firestore.Query.DESCENDING) \
+                 .order_by('__name__', direction=firestore.Query.DESCENDING)
+    after = decode_cursor(cursor)
+    if after is not None:
+        query = query.start_after({'timestamp': after[0], '__name__': after[1]})
+    return query.limit(page_size + 1)
+
+
+def snapshot_to_post(snapshot):
+    post_data = snapshot.to_dict()
+    post_data['post_id'] = snapshot.id  # Include the document ID as 'post_id'
+    return post_data
+
+
+def post_sort_key(post):
+    # Mirrors Firestore's ordering: legacy string timestamps sort after native ones
+    timestamp = post['timestamp']
+    return (isinstance(timestamp, str), timestamp, post['post_id'])
+
+
+def post_cursor(post):
+    # Cursor that resumes right after this post
+    return encode_cursor([post['timestamp'], post['post_id']])
+
+
+def split_page(posts, page_size):
+    # Trim the look-ahead document and build the cursor for the next page
+    if len(posts) <= page_size:
+        return posts, None
+    posts = posts[:page_size]
+    return posts, post_cursor(posts[-1])
+
+
+def fetch_newest_page(query, page_size, cursor=None):
+    posts = [snapshot_to_post(snapshot) for snapshot in newest_first(query, page_size, cursor).stream()]
+    return split_page(posts, page_size)
+
+
+def merge_sorted(sources, key, limit, reverse=False):
+    # k-way heap merge of already-sorted result lists, stopping once the page is full
+    merged = heapq.merge(*sources, key=key, reverse=reverse)
+    page = []
+    for item in merged:
+        page.append(item)
+        if len(page) >= limit:
+            break
+    return page
+
+
+class BatchWriter:
+    # Collects writes into WriteBatch commits of up to BATCH_WRITE_LIMIT operations.
+    # Each full batch is committed on the async client while the caller keeps adding
+    # writes, with at most `concurrency` commits in flight; commit() waits for all of
+    # them and records how long each took.
+
+    def __init__(self, label='batch', limit=BATCH_WRITE_LIMIT, concurrency=FANOUT_CONCURRENCY):
+        self.label = label
+        self.limit = limit
+        self.concurrency = concurrency
+        self.batch = []
+        self.in_flight = []  # (write count, future) per submitted batch, oldest first
+        self.writes = 0
+        self.batch_latencies = []
+
+    def update(self, doc_ref, data):
+        self._add('update', doc_ref, data)
+
+    def set(self, doc_ref, data, merge=False):
+        self._add('merge' if merge else 'set', doc_ref, data)
+
+    def delete(self, doc_ref):
+        self._add('delete', doc_ref, None)
+
+    def _add(self, kind, doc_ref, data):
+        self.batch.append((kind, doc_ref.path, data))
+        if len(self.batch) >= self.limit:
+            self._submit()
+
+    def _submit(self):
+        if not self.batch:
+            return
+        if len(self.in_flight) >= self.concurrency:
+            self._wait_oldest()
+        self.in_flight.append((len(self.batch), submit(commit_batch_async(self.batch))))
+        self.batch = []
+
+    def _wait_oldest(self):
+        count, future = self.in_flight.pop(0)
+        latency = future.result()
+        self.batch_latencies.append(latency)
+        self.writes += count
+        operation = f'firestore.batch.{self.label}'
+        observe(operation, latency)
+        count_writes(operation, count)
+        logger.info("%s: committed %d writes in %.1f ms", self.label, count, latency * 1000)
+
+    def _drain(self):
+        # Wait for every submitted batch; the first failure is raised once all have settled
+        error = None
+        while self.in_flight:
+            try:
+                self._wait_oldest()
+            except Exception as exc:
+                error = error or exc
+        if error is not None:
+            raise error
+
+    def commit(self):
+        self._submit()
+        self._drain()
+
+    def stats(self):
+        return {
+            'writes': self.writes,
+            'batches': len(self.batch_latencies),
+            'total_seconds': sum(self.batch_latencies),
+            'max_batch_seconds': max(self.batch_latencies, default=0.0),
+        }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # Only flush the tail if the caller finished cleanly; batches already
+        # submitted are still waited for so none is left running unobserved
+        if exc_type is None:
+            self.commit()
+        else:
+            try:
+                self._drain()
+            except Exception:
+                logger.exception("%s: batch commit failed while handling another error", self.label)
+        return False
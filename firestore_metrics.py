@@ -0,0 +1,182 @@
+# Thin proxies around the Firestore client (or the in-memory stand-in) that time every call
+# and count the documents it reads and writes, reported through metrics. storage.py wraps
+# the selected client once, so every module is covered without changing its call sites.
+# Anything not intercepted here is forwarded to the wrapped object unchanged, and wrapped
+# references are unwrapped before they are handed back to the client library.
+import time
+from metrics import count_reads, count_writes, observe, timed
+
+
+class _Proxy:
+    def __init__(self, target):
+        self._target = target
+
+    def __getattr__(self, name):
+        return getattr(self._target, name)
+
+
+def _unwrap(value):
+    return value._target if isinstance(value, _Proxy) else value
+
+
+def _unwrap_kwargs(kwargs):
+    return {key: _unwrap(value) for key, value in kwargs.items()}
+
+
+class InstrumentedQuery(_Proxy):
+    def __init__(self, target, collection):
+        super().__init__(target)
+        self._collection = collection
+
+    def _derive(self, method, *args, **kwargs):
+        return InstrumentedQuery(getattr(self._target, method)(*args, **kwargs), self._collection)
+
+    def where(self, *args, **kwargs):
+        return self._derive('where', *args, **kwargs)
+
+    def order_by(self, *args, **kwargs):
+        return self._derive('order_by', *args, **kwargs)
+
+    def limit(self, *args, **kwargs):
+        return self._derive('limit', *args, **kwargs)
+
+    def start_after(self, *args, **kwargs):
+        return self._derive('start_after', *args, **kwargs)
+
+    def stream(self, transaction=None):
+        # Timed across the whole iteration without holding a scope open between yields
+        name = f'firestore.{self._collection}.query'
+        start = time.perf_counter()
+        documents = 0
+        try:
+            for snapshot in self._target.stream(transaction=_unwrap(transaction)):
+                documents += 1
+                yield snapshot
+        finally:
+            observe(name, time.perf_counter() - start)
+            count_reads(name, max(1, documents))  # An empty query is still billed one read
+
+    def get(self, transaction=None):
+        return list(self.stream(transaction))
+
+    def on_snapshot(self, callback):
+        # Listeners are billed per changed document, so each delivery counts its changes
+        name = f'firestore.{self._collection}.listen'
+
+        def counted(snapshots, changes, read_time):
+            count_reads(name, len(changes))
+            return callback(snapshots, changes, read_time)
+        return self._target.on_snapshot(counted)
+
+
+class InstrumentedCollection(InstrumentedQuery):
+    def document(self, *args, **kwargs):
+        return InstrumentedDocument(self._target.document(*args, **kwargs), self._collection)
+
+    def add(self, data, *args, **kwargs):
+        name = f'firestore.{self._collection}.add'
+        with timed(name):
+            result, doc_ref = self._target.add(data, *args, **kwargs)
+            count_writes(name, 1)
+        return result, InstrumentedDocument(doc_ref, self._collection)
+
+
+class InstrumentedDocument(_Proxy):
+    def __init__(self, target, collection):
+        super().__init__(target)
+        self._collection = collection
+
+    def __eq__(self, other):
+        return _unwrap(other) == self._target
+
+    def __hash__(self):
+        return hash(self._target)
+
+    def get(self, *args, **kwargs):
+        name = f'firestore.{self._collection}.get'
+        with timed(name):
+            snapshot = self._target.get(*args, **_unwrap_kwargs(kwargs))
+            count_reads(name, 1)
+        return snapshot
+
+    def _write(self, method, *args, **kwargs):
+        name = f'firestore.{self._collection}.{method}'
+        with timed(name):
+            result = getattr(self._target, method)(*args, **kwargs)
+            count_writes(name, 1)
+        return result
+
+    def create(self, *args, **kwargs):
+        return self._write('create', *args, **kwargs)
+
+    def set(self, *args, **kwargs):
+        return self._write('set', *args, **kwargs)
+
+    def update(self, *args, **kwargs):
+        return self._write('update', *args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        return self._write('delete', *args, **kwargs)
+
+
+class InstrumentedWriteBatch(_Proxy):
+    # Writes are counted when the batch commits
+    def __init__(self, target):
+        super().__init__(target)
+        self._pending = 0
+
+    def _stage(self, method, doc_ref, *args, **kwargs):
+        self._pending += 1
+        return getattr(self._target, method)(_unwrap(doc_ref), *args, **kwargs)
+
+    def create(self, doc_ref, *args, **kwargs):
+        return self._stage('create', doc_ref, *args, **kwargs)
+
+    def set(self, doc_ref, *args, **kwargs):
+        return self._stage('set', doc_ref, *args, **kwargs)
+
+    def update(self, doc_ref, *args, **kwargs):
+        return self._stage('update', doc_ref, *args, **kwargs)
+
+    def delete(self, doc_ref, *args, **kwargs):
+        return self._stage('delete', doc_ref, *args, **kwargs)
+
+    def commit(self, *args, **kwargs):
+        with timed('firestore.batch.commit'):
+            result = self._target.commit(*args, **kwargs)
+            count_writes('firestore.batch.commit', self._pending)
+        self._pending = 0
+        return result
+
+
+class InstrumentedTransaction(InstrumentedWriteBatch):
+    # @firestore.transactional drives the wrapped transaction itself, so writes are
+    # counted as they are staged (a retried attempt is counted again, as it is billed)
+    def _stage(self, method, doc_ref, *args, **kwargs):
+        count_writes('firestore.transaction', 1)
+        return getattr(self._target, method)(_unwrap(doc_ref), *args, **kwargs)
+
+    def commit(self, *args, **kwargs):
+        return self._target.commit(*args, **kwargs)
+
+
+class InstrumentedClient(_Proxy):
+    def collection(self, name):
+        return InstrumentedCollection(self._target.collection(name), name)
+
+    def get_all(self, references, *args, **kwargs):
+        references = [_unwrap(reference) for reference in references]
+        with timed('firestore.get_all'):
+            snapshots = list(self._target.get_all(references, *args, **_unwrap_kwargs(kwargs)))
+            count_reads('firestore.get_all', len(references))
+        return snapshots
+
+    def batch(self):
+        return InstrumentedWriteBatch(self._target.batch())
+
+    def transaction(self, *args, **kwargs):
+        return InstrumentedTransaction(self._target.transaction(*args, **kwargs))
+
+
+def instrument_client(client):
+    return InstrumentedClient(client)
@@ -3,14 +3,21 @@ from cryptography.x509.oid import NameOID
 from datetime import datetime, timedelta, timezone
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.asymmetric import ed25519, rsa, x25519
 from cryptography.hazmat.backends import default_backend
-import os
+from encrypt_decrypt import store_private_key
 
-def generate_key_pair(name):
-    print("Generating keys and certificate")
-    private_key = rsa.generate_private_key(
+def generate_private_key():
+    return rsa.generate_private_key(
         public_exponent=65537, key_size=2048, backend=default_backend())
+
+
+def generate_key_pair(name, private_key=None):
+    # private_key lets callers supply a pre-generated key (see key_pool); the
+    # certificate is always issued for `name` here
+    if private_key is None:
+        print("Generating keys and certificate")
+        private_key = generate_private_key()
     public_key = private_key.public_key()
 
     # Create a self-signed certificate
@@ -41,17 +48,8 @@ def generate_key_pair(name):
     # Sign our certificate with our private key
     ).sign(private_key, hashes.SHA256(), default_backend())
 
-    # Ensure the keys directory exists
-    if not os.path.exists('keys'):
-        os.makedirs('keys')
-
-    # Serialize private key
-    with open('keys/' + name + '_private_key.pem', 'wb') as f:
-        f.write(private_key.private_bytes(
-            encoding=serialization.Encoding.PEM,
-            format=serialization.PrivateFormat.PKCS8,
-            encryption_algorithm=serialization.NoEncryption()
-        ))
+    # Store the private key in the keystore (this also drops any stale parsed copy)
+    store_private_key(name, private_key)
 
     # Serialize public key
     #with open('keys/' + name + '_public_key.pem', 'wb') as f:
@@ -66,3 +64,18 @@ def generate_key_pair(name):
         #f.write(cert_pem)
 
     return cert_pem
+
+
+def generate_ec_identity(name):
+    # X25519 key for the 'x25519' key-wrap scheme plus an Ed25519 signing key.
+    # Private keys go into the keystore next to the RSA key; the raw public keys are returned for the user document.
+    public_keys = {}
+    for kind, private_key in (('x25519', x25519.X25519PrivateKey.generate()),
+                              ('ed25519', ed25519.Ed25519PrivateKey.generate())):
+        store_private_key(name, private_key, kind)
+        public_keys[f'{kind}_public_key'] = private_key.public_key().public_bytes(
+            encoding=serialization.Encoding.Raw,
+            format=serialization.PublicFormat.Raw
+        )
+
+    return public_keys
@@ -1,8 +1,268 @@
-from encrypt_decrypt import encrypt_for_group_members, decrypt_message_with_private_key
-from firebase_admin_utils import db
-from cryptography import x509
+from audience_index import create_group_document, read_audience, update_group_members
+from encrypt_decrypt import KEY_WRAP_SCHEME, add_member_entries, decrypt_envelope, decrypt_with_symmetric_key, generate_group_key, get_wrap_executor, key_id, open_envelope, seal_envelope, unwrap_envelope_for_member, unwrap_symmetric_key, wrap_key_for_members, wrap_symmetric_key
+from feed_cache import invalidate_users
+from firebase_admin_utils import remember_usernames
+from storage import db, firestore
+from firestore_batch import get_documents, merge_sorted, newest_first, post_sort_key, query_where_in_slices, snapshot_to_post, split_page
+from reencrypt_jobs import enqueue_job, register_job_kind
 from cryptography.hazmat.backends import default_backend
-from firebase_admin import firestore
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PublicKey
+import hashlib
+import threading
+import time
+
+# Number of posts shown per page of the group feed
+FEED_PAGE_SIZE = 20
+
+# Parsed public keys are cached by certificate fingerprint for this many seconds
+PUBLIC_KEY_CACHE_TTL = 600
+
+# fingerprint -> (expiry time, public key)
+_public_key_cache = {}
+_public_key_cache_lock = threading.Lock()
+
+
+def certificate_fingerprint(certificate_pem):
+    return hashlib.sha256(certificate_pem).hexdigest()
+
+
+def load_public_key_from_certificate(certificate_pem):
+    # Hashing the PEM is far cheaper than parsing the X.509 certificate again
+    fingerprint = certificate_fingerprint(certificate_pem)
+    now = time.monotonic()
+    with _public_key_cache_lock:
+        cached = _public_key_cache.get(fingerprint)
+        if cached is not None and cached[0] > now:
+            return cached[1]
+
+    # Load the X.509 certificate and extract the public key from it
+    from cryptography import x509
+    certificate = x509.load_pem_x509_certificate(
+        certificate_pem,
+        backend=default_backend()
+    )
+    public_key = certificate.public_key()
+
+    with _public_key_cache_lock:
+        # Sweep expired entries so rotated certificates don't pile up
+        for stale in [fp for fp, (expiry, _) in _public_key_cache.items() if expiry <= now]:
+            del _public_key_cache[stale]
+        _public_key_cache[fingerprint] = (now + PUBLIC_KEY_CACHE_TTL, public_key)
+    return public_key
+
+
+def invalidate_public_key_cache(certificate_pem=None):
+    # Drop one certificate's cached key, or the whole cache if none is given
+    with _public_key_cache_lock:
+        if certificate_pem is None:
+            _public_key_cache.clear()
+        else:
+            _public_key_cache.pop(certificate_fingerprint(certificate_pem), None)
+
+def recipient_public_key(user_data):
+    # The key new wraps for this user should use: X25519 when that scheme is selected
+    # and the user has one, otherwise the RSA key from their certificate
+    if KEY_WRAP_SCHEME == 'x25519' and user_data.get('x25519_public_key'):
+        return X25519PublicKey.from_public_bytes(user_data['x25519_public_key'])
+    return load_public_key_from_certificate(user_data.get('certificate'))
+
+
+def get_public_keys(user_ids):
+    # Fetch certificates for all these users with concurrent batched reads and extract public keys
+    public_keys = {}
+    usernames = {}
+    for user_doc in get_documents('users', user_ids):
+        if user_doc.exists:
+            user_data = user_doc.to_dict()
+            public_keys[user_doc.id] = recipient_public_key(user_data)
+            usernames[user_doc.id] = user_data.get('username')
+
+    # The same documents carry usernames, so feed rendering doesn't need to read them again
+    remember_usernames(usernames)
+    return public_keys
+
+
+def _commit_group_epoch(transaction, group_ref, wrapped_keys, expected_epoch):
+    # Bump the epoch atomically so concurrent rotations can't overwrite each other.
+    # Run through firestore.transactional at call time, so importing this module
+    # doesn't load the Firestore client library.
+    snapshot = group_ref.get(transaction=transaction)
+    current_epoch = snapshot.to_dict().get('epoch', 0)
+    if expected_epoch is not None and current_epoch != expected_epoch:
+        return None
+    epoch = current_epoch + 1
+    transaction.update(group_ref, {'epoch': epoch, f'epoch_keys.{epoch}': wrapped_keys})
+    return epoch
+
+
+def rotate_group_epoch(group_id, members, expected_epoch=None):
+    # Start a new group key epoch, wrapping a fresh group key once per member.
+    # Posts written under earlier epochs are left untouched.
+    # Returns (epoch, group_key), or None if expected_epoch no longer matches.
+    group_key = generate_group_key()
+    wrapped_keys = wrap_key_for_members(get_public_keys(members), group_key, get_wrap_executor())
+    group_ref = db.collection('groups').document(group_id)
+    epoch = firestore.transactional(_commit_group_epoch)(db.transaction(), group_ref, wrapped_keys, expected_epoch)
+    if epoch is None:
+        return None
+    return epoch, group_key
+
+
+def get_group_epoch_key(group_id, epoch, user_id, key_cache, group_data=None):
+    # Unwrap a group's epoch key for user_id; key_cache holds unwrapped keys so each
+    # (group, epoch) costs one RSA operation per session
+    cache_key = (group_id, epoch)
+    if cache_key in key_cache:
+        return key_cache[cache_key]
+
+    if group_data is None:
+        group_doc = db.collection('groups').document(group_id).get()
+        if not group_doc.exists:
+            return None
+        group_data = group_doc.to_dict()
+
+    wrapped_key = group_data.get('epoch_keys', {}).get(str(epoch), {}).get(user_id)
+    if wrapped_key is None:
+        return None  # user_id was never given this epoch's key
+
+    group_key = unwrap_symmetric_key(wrapped_key, user_id)
+    key_cache[cache_key] = group_key
+    return group_key
+
+
+def load_group_epoch_keys(group_epochs, user_id, key_cache):
+    # Unwrap many (group_id, epoch) keys at once: one batched read of the group
+    # documents, then the RSA unwraps spread over the worker pool
+    missing = {(group_id, epoch) for group_id, epoch in group_epochs if (group_id, epoch) not in key_cache}
+    if not missing:
+        return
+
+    group_ids = {group_id for group_id, _ in missing}
+    groups = {
+        group_doc.id: group_doc.to_dict()
+        for group_doc in get_documents('groups', group_ids)
+        if group_doc.exists
+    }
+
+    wrapped_keys = {}
+    for group_id, epoch in missing:
+        group_data = groups.get(group_id, {})
+        wrapped_key = group_data.get('epoch_keys', {}).get(str(epoch), {}).get(user_id)
+        if wrapped_key is not None:
+            wrapped_keys[(group_id, epoch)] = wrapped_key
+
+    pairs = list(wrapped_keys)
+    unwrapped = get_wrap_executor().map(lambda pair: unwrap_symmetric_key(wrapped_keys[pair], user_id), pairs)
+    for pair, group_key in zip(pairs, unwrapped):
+        key_cache[pair] = group_key
+
+
+def get_current_group_keys(user_id, key_cache):
+    # Current (epoch, group_key) for every group user_id belongs to
+    groups_ref = db.collection('groups')
+    groups = groups_ref.where('members', 'array_contains', user_id).get()
+
+    current_keys = {}
+    for group in groups:
+        group_data = group.to_dict()
+        epoch = group_data.get('epoch')
+        if not epoch:
+            # Groups created before epochs existed get their first key on first use
+            rotated = rotate_group_epoch(group.id, group_data.get('members', []), expected_epoch=0)
+            if rotated is None:
+                # Another member initialised it first; read theirs
+                group_data = groups_ref.document(group.id).get().to_dict()
+                epoch = group_data.get('epoch')
+                group_key = get_group_epoch_key(group.id, epoch, user_id, key_cache, group_data)
+            else:
+                epoch, group_key = rotated
+                key_cache[(group.id, epoch)] = group_key
+        else:
+            group_key = get_group_epoch_key(group.id, epoch, user_id, key_cache, group_data)
+
+        if group_key is not None:
+            current_keys[group.id] = (epoch, group_key)
+
+    return current_keys
+
+
+def member_wrapped_key(post_data, user_id):
+    # Data key of a post whose key is wrapped per member (legacy Fernet or envelope member
+    # entries), or None if user_id holds no such key. Group-keyed posts also give None.
+    if 'envelope' in post_data:
+        envelope = open_envelope(post_data['envelope'])
+        if envelope.group_entries:
+            return None  # Group-keyed; its member entry is only the author's own copy
+        return unwrap_envelope_for_member(envelope, user_id)
+    encrypted_key = post_data.get('encrypted_keys', {}).get(user_id)
+    if encrypted_key is None:
+        return None
+    return unwrap_symmetric_key(encrypted_key, user_id)
+
+def _decrypt_with_data_key(post_data, data_key):
+    if 'envelope' in post_data:
+        return decrypt_envelope(post_data['envelope'], data_key)
+    return decrypt_with_symmetric_key(post_data['encrypted_text'], data_key)
+
+def member_wrapped_plaintext(post_data, user_id):
+    # Plaintext of a member-wrapped post (see member_wrapped_key), or None
+    data_key = member_wrapped_key(post_data, user_id)
+    return None if data_key is None else _decrypt_with_data_key(post_data, data_key)
+
+def reseal_for_members(post_data, member_public_keys, admin_id):
+    # Update that replaces a member-wrapped post with an envelope for member_public_keys, or None.
+    # The post keeps its data key: its attachments' keys are derived from it.
+    data_key = member_wrapped_key(post_data, admin_id)
+    if data_key is None:
+        return None
+    message = _decrypt_with_data_key(post_data, data_key)
+    return {
+        'envelope': seal_envelope(message, member_public_keys=member_public_keys, executor=get_wrap_executor(), data_key=data_key),
+        'encrypted_text': firestore.DELETE_FIELD,
+        'encrypted_keys': firestore.DELETE_FIELD
+    }
+
+def grant_member_update(post_data, user_id, public_key, admin_id):
+    # Update that lets user_id read a member-wrapped post without re-encrypting it, or None
+    # if they already can, the admin can't read it, or it is group-keyed
+    if 'envelope' in post_data:
+        envelope = open_envelope(post_data['envelope'])
+        if envelope.group_entries or key_id(user_id) in envelope.member_entries:
+            return None
+        symmetric_key = unwrap_envelope_for_member(envelope, admin_id)
+        if symmetric_key is None:
+            return None
+        return {'envelope': add_member_entries(envelope.raw, {user_id: wrap_symmetric_key(public_key, symmetric_key)})}
+
+    encrypted_keys = post_data.get('encrypted_keys', {})
+    if admin_id not in encrypted_keys or user_id in encrypted_keys:
+        return None
+    symmetric_key = unwrap_symmetric_key(encrypted_keys[admin_id], admin_id)
+    return {f'encrypted_keys.{user_id}': wrap_symmetric_key(public_key, symmetric_key)}
+
+# Background re-encryption jobs (see reencrypt_jobs): prepare loads the keys once per job run,
+# then each post gets its update
+def _prepare_grant_job(job):
+    # A job retried after the member was removed again must not grant them anything
+    group_doc = db.collection('groups').document(job['group_id']).get()
+    if not group_doc.exists or job['user_id'] not in group_doc.to_dict().get('members', []):
+        return None
+    return {'admin_id': job['admin_id'], 'user_id': job['user_id'], 'public_key': get_public_keys([job['user_id']])[job['user_id']]}
+
+def _grant_job_update(context, post_data):
+    if context is None:
+        return None
+    return grant_member_update(post_data, context['user_id'], context['public_key'], context['admin_id'])
+
+def _prepare_reseal_job(job):
+    # Current members' keys, so a resumed job seals for whoever is in the group now
+    return {'admin_id': job['admin_id'], 'member_keys': get_group_member_public_keys(job['admin_id'])}
+
+def _reseal_job_update(context, post_data):
+    return reseal_for_members(post_data, context['member_keys'], context['admin_id'])
+
+register_job_kind('grant_member', _prepare_grant_job, _grant_job_update)
+register_job_kind('reseal_members', _prepare_reseal_job, _reseal_job_update)
 
 def create_group(group_name, admin_id):
     groups_ref = db.collection('groups')
@@ -15,14 +275,13 @@ def create_group(group_name, admin_id):
     if admin_already_has_group:
         return None # Admin already has group
     
-    _, group_doc_ref = groups_ref.add({  # Unpack the tuple to get the DocumentReference
-        'name': group_name,
-        'admin': admin_id,
-        'members': [admin_id]
-    })
-    return group_doc_ref.id  # Now correctly getting the ID from the DocumentReference
-
-def add_user_to_group(group_name, username_to_add, admin_id):
+    # Written together with the admin's audience document
+    group_id = create_group_document({'name': group_name, 'admin': admin_id}, [admin_id])
+    rotate_group_epoch(group_id, [admin_id])
+    invalidate_users([admin_id])
+    return group_id
+
+def add_user_to_group(group_name, username_to_add, admin_id, full_reencrypt=False):
     # Find the user ID of the user to add
     users_ref = db.collection('users')
     user_docs = users_ref.where('username', '==', username_to_add).get()
@@ -30,14 +289,9 @@ def add_user_to_group(group_name, username_to_add, admin_id):
         return "User not found"
     
     user_to_add_id = user_docs[0].id
-    user_to_add_pub_key = user_docs[0].to_dict().get('certificate')
-    
+
     # Load the user's public key
-    certificate = x509.load_pem_x509_certificate(
-        user_to_add_pub_key,
-        backend=default_backend()
-    )
-    user_to_add_public_key = certificate.public_key()
+    user_to_add_public_key = recipient_public_key(user_docs[0].to_dict())
     
     # Find the group and add the user to it
     groups_ref = db.collection('groups')
@@ -50,71 +304,39 @@ def add_user_to_group(group_name, username_to_add, admin_id):
     if user_to_add_id in group.to_dict()['members']:
         return "User already in the group"
     
-    # Add user to the group
-    groups_ref.document(group.id).update({
-        'members': firestore.ArrayUnion([user_to_add_id])
-    })
-    
-    # Re-encrypt existing posts for the new group member
-    posts_ref = db.collection('posts')
-    group_members = group.to_dict()['members'] + [user_to_add_id]  # Include the new member in the encryption
-    
-    for member_id in group_members:
-        user_posts = posts_ref.where('user_id', '==', member_id).stream()
-        for post in user_posts:
-            post_data = post.to_dict()
-            # Assuming post_data contains 'encrypted_text' and 'encrypted_keys'
-            encrypted_msg = post_data['encrypted_text']
-            encrypted_keys = post_data['encrypted_keys']
-            
-            # Fetch public keys of all current members including the new one
-            all_member_keys = get_group_member_public_keys(admin_id)  # Might need to adjust this to ensure it includes the new user
-            all_member_keys[user_to_add_id] = user_to_add_public_key
-            
-            # Re-encrypt the message for all group members
-            new_encrypted_msg, new_encrypted_keys = encrypt_for_group_members(all_member_keys, decrypt_message_with_private_key(encrypted_msg, encrypted_keys[admin_id], admin_id))
-            
-            # Update the post with new encrypted keys
-            posts_ref.document(post.id).update({'encrypted_keys': new_encrypted_keys})
-            posts_ref.document(post.id).update({'encrypted_text': new_encrypted_msg})
-    
-    return "User added successfully and posts updated"
+    # Add user to the group, updating every member's audience in the same transaction
+    update_group_members(group.id, add=[user_to_add_id])
 
-def get_group_member_public_keys(user_id):
-    # Fetch all groups where user_id is a member
-    groups_ref = db.collection('groups')
-    user_groups = groups_ref.where('members', 'array_contains', user_id).get()
-    print(f"USER GROUPS LENGTH: {len(user_groups)}")
-    user_ids = set()
-    for group in user_groups:
-        members = group.to_dict().get('members', [])
-        user_ids.update(members)
-
-    # Remove the original user_id to avoid encrypting for oneself
-    #user_ids.discard(user_id)
-
-    # Fetch certificates for all these users and extract public keys
-    users_ref = db.collection('users')
-    group_member_public_keys = {}
-    for uid in user_ids:
-        user_doc = users_ref.document(uid).get()
-        if user_doc.exists:
-            user_data = user_doc.to_dict()
-            certificate_pem = user_data.get('certificate')
+    # Give the new member every earlier epoch key so they can read the group's history,
+    # then rotate so the group moves on to a key that includes them
+    group_data = group.to_dict()
+    key_cache = {}
+    epoch_key_grants = {}
+    for epoch in group_data.get('epoch_keys', {}):
+        group_key = get_group_epoch_key(group.id, int(epoch), admin_id, key_cache, group_data)
+        if group_key is not None:
+            epoch_key_grants[f'epoch_keys.{epoch}.{user_to_add_id}'] = wrap_symmetric_key(user_to_add_public_key, group_key)
+    if epoch_key_grants:
+        groups_ref.document(group.id).update(epoch_key_grants)
+    rotate_group_epoch(group.id, group_data['members'] + [user_to_add_id])
 
+    group_members = group.to_dict()['members'] + [user_to_add_id]  # Include the new member in the encryption
 
-            # Load the X.509 certificate
-            certificate = x509.load_pem_x509_certificate(
-                certificate_pem,
-                backend=default_backend()
-            )
+    # Existing posts are updated in the background: either the new member is granted access to
+    # each post (its key unwrapped once and wrapped for them only), or every post is re-sealed
+    # for all current members. Epoch-keyed posts are covered by the epoch key grants above.
+    kind = 'reseal_members' if full_reencrypt else 'grant_member'
+    job_id = enqueue_job(kind, group.id, admin_id, group_members, user_id=user_to_add_id)
 
-            # Extract the public key from the certificate
-            public_key = certificate.public_key()
+    invalidate_users(group_members)
+    return f"User added successfully; posts are being updated in the background (job {job_id})"
 
-            group_member_public_keys[uid] = public_key
+def get_group_member_public_keys(user_id):
+    # Everyone sharing a group with user_id, user_id included, from their audience document
+    user_ids = read_audience(user_id)['members']
 
-    return group_member_public_keys
+    # Fetch certificates for all these users and extract public keys
+    return get_public_keys(user_ids)
 
 def remove_user_from_group(group_name, username_to_remove, admin_id):
     # Find the user ID of the user to remove
@@ -136,74 +358,45 @@ def remove_user_from_group(group_name, username_to_remove, admin_id):
     if user_to_remove_id not in group.to_dict()['members']:
         return "User is not in the group"
     
-    # Remove the user from the group
-    groups_ref.document(group.id).update({
-        'members': firestore.ArrayRemove([user_to_remove_id])
-    })
+    # Remove the user from the group, updating every member's audience in the same transaction
+    update_group_members(group.id, remove=[user_to_remove_id])
 
     # Update group_members to exclude the removed user
     group_members = [member for member in group.to_dict()['members'] if member != user_to_remove_id]
 
-    # Fetch all posts made by the group members
-    posts_ref = db.collection('posts')
-    group_posts = posts_ref.where('user_id', 'in', group_members).stream()
+    # Rotate to a key the removed user never gets. Earlier epochs are history and are left
+    # alone: they already held those keys, and authors keep access to their own old posts.
+    rotate_group_epoch(group.id, group_members)
 
-    for post in group_posts:
-        post_data = post.to_dict()
-        encrypted_message = post_data['encrypted_text']
-        encrypted_keys = post_data['encrypted_keys']
+    # Re-seal the remaining members' posts without the removed user's key in the background.
+    # Epoch-keyed posts are left as they are; new posts use the rotated epoch.
+    job_id = enqueue_job('reseal_members', group.id, admin_id, group_members, user_id=user_to_remove_id)
 
-        # Check if the user to remove's encrypted key exists in the post
-        if user_to_remove_id in encrypted_keys:
-            # Remove the user's encrypted key from the post
-            del encrypted_keys[user_to_remove_id]
+    invalidate_users(group_members + [user_to_remove_id])
+    return f"User removed successfully; posts are being re-encrypted for the remaining members in the background (job {job_id})"
 
-        # Decrypt the message using the admin's private key for re-encryption
-        decrypted_message = decrypt_message_with_private_key(
-            encrypted_message,
-            encrypted_keys[admin_id],
-            admin_id
-        )
 
-        # Fetch public keys of all remaining members
-        remaining_member_keys = get_group_member_public_keys(admin_id)
+def get_group_posts(user_id, page_size=FEED_PAGE_SIZE, cursor=None):
+    # Returns one page of posts from the user's group members, newest first,
+    # and a cursor for the next page (None once the feed is exhausted)
 
-        # Re-encrypt the message for all remaining group members
-        new_encrypted_msg, new_encrypted_keys = encrypt_for_group_members(remaining_member_keys, decrypted_message)
-
-        # Update the post with the new encrypted message and keys
-        posts_ref.document(post.id).update({
-            'encrypted_text': new_encrypted_msg,
-            'encrypted_keys': new_encrypted_keys
-        })
-
-    return "User removed successfully and posts updated for remaining group members"
-
-def get_group_posts(user_id):
-    # Step 1: Find all groups where the current user is a member
-    groups_ref = db.collection('groups')
-    groups = groups_ref.where('members', 'array_contains', user_id).get()
-
-    # Step 2: Collect unique user IDs from these groups
-    user_ids = set()
-    for group in groups:
-        members = group.to_dict().get('members', [])
-        user_ids.update(members)
+    # Steps 1-2: Everyone sharing a group with the current user, from their audience document
+    user_ids = set(read_audience(user_id)['members'])
 
     # Optionally remove the current user's ID from the set if you don't want to see your own posts
     user_ids.discard(user_id)
 
-    # Step 3: Fetch posts made by these users
-    posts_ref = db.collection('posts')
-    posts = []
-    for uid in user_ids:
-        user_posts = posts_ref.where('user_id', '==', uid).order_by('timestamp', direction=firestore.Query.DESCENDING).stream()
-        for post in user_posts:
-            post_data = post.to_dict()
-            post_data['post_id'] = post.id  # Include the document ID as 'post_id'
-            posts.append(post_data)
-
-    # Optionally, you might want to sort all posts by timestamp here, as they are grouped by user above
-    posts.sort(key=lambda x: x['timestamp'], reverse=True)
+    # Step 3: Each 'in' slice reads at most one page, ordered newest first and resuming after the cursor
+    slices = query_where_in_slices(
+        'posts', 'user_id', sorted(user_ids),
+        lambda query: newest_first(query, page_size, cursor)
+    )
 
-    return posts
\ No newline at end of file
+    # Step 4: Merge the slices, which are each already sorted, and keep only one page
+    posts = merge_sorted(
+        [[snapshot_to_post(snapshot) for snapshot in result] for result in slices],
+        key=post_sort_key,
+        limit=page_size + 1,
+        reverse=True,
+    )
+    return split_page(posts, page_size)
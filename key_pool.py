@@ -0,0 +1,137 @@
+# Background pool of pre-generated RSA private keys, so signup only has to issue
+# a certificate for the new uid instead of generating a 2048-bit key inline.
+# The pool is refilled by a process pool up to KEY_POOL_SIZE keys. If that pool breaks
+# (a worker was killed) or was shut down, refilling drops it and the next refill starts a
+# new one; until then take() returns None and signup generates its key inline.
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from cryptography.hazmat.primitives import serialization
+from gen_keys import generate_key_pair, generate_private_key
+from metrics import register_gauges
+
+logger = logging.getLogger(__name__)
+
+KEY_POOL_SIZE = int(os.getenv('KEY_POOL_SIZE', '16'))
+KEY_POOL_WORKERS = int(os.getenv('KEY_POOL_WORKERS', str(max(1, (os.cpu_count() or 2) // 2))))
+
+
+def _generate_private_key_der():
+    # Runs in a worker process; keys travel back as DER bytes because key objects can't be pickled
+    return generate_private_key().private_bytes(
+        encoding=serialization.Encoding.DER,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption()
+    )
+
+
+class KeyPairPool:
+    def __init__(self, size=KEY_POOL_SIZE, workers=KEY_POOL_WORKERS):
+        self.size = size
+        self.workers = workers
+        self._keys = deque()
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._executor = None
+        self._started_at = time.monotonic()
+        self._generated = 0
+        self._taken = 0
+        self._misses = 0
+
+    def _ensure_executor(self):
+        if self._executor is None:
+            # spawn keeps Streamlit's threads and sockets out of the workers
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return self._executor
+
+    def refill(self):
+        # Top the pool up to its watermark, counting keys that are already being generated
+        with self._lock:
+            wanted = self.size - len(self._keys) - self._in_flight
+            if wanted <= 0:
+                return
+            self._in_flight += wanted
+            executor = self._ensure_executor()
+        submitted = 0
+        try:
+            for _ in range(wanted):
+                executor.submit(_generate_private_key_der).add_done_callback(self._on_generated)
+                submitted += 1
+        except Exception:
+            # BrokenProcessPool or RuntimeError after shutdown: stop counting the keys that
+            # will never arrive and build a fresh executor on the next refill
+            logger.exception("Key pool refill failed; signups generate keys inline until it recovers")
+            with self._lock:
+                self._in_flight -= wanted - submitted
+                if self._executor is executor:
+                    self._executor = None
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _on_generated(self, future):
+        with self._lock:
+            self._in_flight -= 1
+            # Futures cancelled by shutdown() raise CancelledError from exception()
+            if not future.cancelled() and future.exception() is None:
+                self._keys.append(future.result())
+                self._generated += 1
+
+    def take(self):
+        # Returns a ready private key, or None if the pool is empty (the caller then generates inline)
+        with self._lock:
+            key_der = self._keys.popleft() if self._keys else None
+            if key_der is None:
+                self._misses += 1
+            else:
+                self._taken += 1
+        self.refill()
+        if key_der is None:
+            return None
+        # These keys came straight from our own workers, so the (slow) RSA consistency check is skipped
+        return serialization.load_der_private_key(key_der, password=None, unsafe_skip_rsa_key_validation=True)
+
+    def metrics(self):
+        with self._lock:
+            elapsed = time.monotonic() - self._started_at
+            return {
+                'depth': len(self._keys),
+                'target': self.size,
+                'in_flight': self._in_flight,
+                'generated': self._generated,
+                'taken': self._taken,
+                'misses': self._misses,
+                'refill_per_sec': self._generated / elapsed if elapsed else 0.0,
+            }
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_key_pool():
+    # Process-wide pool, started (and filling) on first use
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = KeyPairPool()
+            _pool.refill()
+            # Pool depth, refill rate and misses show up on /metrics as app_key_pool_*
+            register_gauges('key_pool', _pool.metrics)
+        return _pool
+
+
+def issue_key_pair(name):
+    # Same contract as generate_key_pair: writes the private key and returns the certificate PEM
+    return generate_key_pair(name, private_key=get_key_pool().take())
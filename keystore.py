@@ -0,0 +1,209 @@
+# Encrypted, append-only keystore for users' private keys: one data file instead of a
+# PEM file per user in keys/, read through mmap so loading a key is a dict lookup and a
+# slice of the mapping rather than a filesystem lookup and a file read.
+#
+# File layout (KEYSTORE_PATH):
+#   header:  magic 'SMKS' | version u8 | scrypt salt (16) | passphrase check tag (16)
+#   records: u32 length of the rest | u16 name length | name | nonce (12) | AES-GCM ciphertext
+# A record's name is '<uid>/<kind>' and doubles as the AES-GCM associated data, so a record
+# can't be passed off as another user's key. Keys are never rewritten in place: storing a
+# key again appends a new record and the index points at the newest one.
+#
+# The key-encryption key is derived from KEYSTORE_PASSPHRASE with scrypt once per process.
+# Without a passphrase there is no keystore and encrypt_decrypt reads and writes the
+# per-user PEM files in keys/ as before, so the keystore is opt-in until keys are migrated.
+# The uid -> offset index is built by walking the record headers when the file is opened
+# and extended when a lookup misses or this process appends, which picks up keys written
+# by other processes since. Appends are serialised across processes with flock where available.
+import mmap
+import os
+import struct
+import threading
+from dotenv import load_dotenv
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+
+try:
+    import fcntl
+except ImportError:  # Windows: appends are only serialised within this process
+    fcntl = None
+
+load_dotenv()
+KEYSTORE_PATH = os.getenv('KEYSTORE_PATH', 'keys/keystore.dat')
+KEYSTORE_PASSPHRASE = os.getenv('KEYSTORE_PASSPHRASE')
+
+KEYSTORE_MAGIC = b'SMKS'
+KEYSTORE_VERSION = 1
+_HEADER = struct.Struct('>4sB16s16s')
+_RECORD_LENGTH = struct.Struct('>I')
+_NAME_LENGTH = struct.Struct('>H')
+_NONCE_SIZE = 12
+_CHECK_AAD = b'keystore passphrase check'
+
+# scrypt cost: ~0.1 s and 32 MiB, paid once per process
+_SCRYPT_N = 2 ** 15
+_SCRYPT_R = 8
+_SCRYPT_P = 1
+
+
+def key_entry_name(uid, kind='rsa'):
+    return f'{uid}/{kind}'
+
+
+def _derive_kek(passphrase, salt):
+    return Scrypt(salt=salt, length=32, n=_SCRYPT_N, r=_SCRYPT_R, p=_SCRYPT_P).derive(passphrase.encode())
+
+
+class Keystore:
+    def __init__(self, path=KEYSTORE_PATH, passphrase=KEYSTORE_PASSPHRASE):
+        if not passphrase:
+            raise RuntimeError("KEYSTORE_PASSPHRASE must be set to read or write private keys")
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        self._lock = threading.Lock()
+        self._index = {}  # name -> offset of its newest record
+        self._map = None
+        self._scanned = _HEADER.size
+
+        with self._file_lock():
+            if os.fstat(self._fd).st_size == 0:
+                salt = os.urandom(16)
+                self._aead = AESGCM(_derive_kek(passphrase, salt))
+                check = self._aead.encrypt(bytes(_NONCE_SIZE), b'', _CHECK_AAD)
+                os.write(self._fd, _HEADER.pack(KEYSTORE_MAGIC, KEYSTORE_VERSION, salt, check))
+                os.fsync(self._fd)
+            else:
+                magic, version, salt, check = _HEADER.unpack(self._read_header())
+                if magic != KEYSTORE_MAGIC or version != KEYSTORE_VERSION:
+                    raise ValueError(f"{path} is not a version {KEYSTORE_VERSION} keystore")
+                self._aead = AESGCM(_derive_kek(passphrase, salt))
+                try:
+                    self._aead.decrypt(bytes(_NONCE_SIZE), check, _CHECK_AAD)
+                except InvalidTag:
+                    raise ValueError(f"KEYSTORE_PASSPHRASE does not open {path}") from None
+        with self._lock, self._file_lock(shared=True):
+            self._refresh()
+
+    def _file_lock(self, shared=False):
+        return _FileLock(self._fd, shared)
+
+    def _read_header(self):
+        os.lseek(self._fd, 0, os.SEEK_SET)
+        return os.read(self._fd, _HEADER.size)
+
+    def _refresh(self):
+        # Map the file as it is now and index any records appended since the last scan.
+        # A record cut short by a crash mid-append is left out of the index.
+        # Callers hold the file lock, so no append is half-written while this runs.
+        size = os.fstat(self._fd).st_size
+        if self._map is not None and len(self._map) == size:
+            return
+        if self._map is not None:
+            self._map.close()
+        self._map = mmap.mmap(self._fd, size, access=mmap.ACCESS_READ)
+        offset = self._scanned
+        while offset + _RECORD_LENGTH.size + _NAME_LENGTH.size <= size:
+            (length,) = _RECORD_LENGTH.unpack_from(self._map, offset)
+            end = offset + _RECORD_LENGTH.size + length
+            if end > size:
+                break
+            (name_length,) = _NAME_LENGTH.unpack_from(self._map, offset + _RECORD_LENGTH.size)
+            name_start = offset + _RECORD_LENGTH.size + _NAME_LENGTH.size
+            self._index[self._map[name_start:name_start + name_length].decode()] = offset
+            offset = end
+        self._scanned = offset
+
+    def locate(self, name):
+        # Offset of the newest record for name, or None; a miss re-checks the file for new records
+        with self._lock:
+            offset = self._index.get(name)
+            if offset is None:
+                with self._file_lock(shared=True):
+                    self._refresh()
+                offset = self._index.get(name)
+            return offset
+
+    def read_at(self, offset, name):
+        # Decrypt the record at offset (as returned by locate) for name
+        with self._lock:
+            (length,) = _RECORD_LENGTH.unpack_from(self._map, offset)
+            record = self._map[offset + _RECORD_LENGTH.size:offset + _RECORD_LENGTH.size + length]
+        (name_length,) = _NAME_LENGTH.unpack_from(record, 0)
+        encoded_name = name.encode()
+        if record[_NAME_LENGTH.size:_NAME_LENGTH.size + name_length] != encoded_name:
+            raise KeyError(name)
+        nonce_start = _NAME_LENGTH.size + name_length
+        nonce = record[nonce_start:nonce_start + _NONCE_SIZE]
+        return self._aead.decrypt(nonce, record[nonce_start + _NONCE_SIZE:], encoded_name)
+
+    def read(self, name):
+        offset = self.locate(name)
+        return None if offset is None else self.read_at(offset, name)
+
+    def put(self, name, data):
+        # Append an encrypted record for name; returns its offset
+        encoded_name = name.encode()
+        nonce = os.urandom(_NONCE_SIZE)
+        body = _NAME_LENGTH.pack(len(encoded_name)) + encoded_name + nonce + self._aead.encrypt(nonce, data, encoded_name)
+        record = _RECORD_LENGTH.pack(len(body)) + body
+        with self._lock, self._file_lock():
+            self._refresh()
+            # Drop a partial record left by a crashed writer so the new one stays reachable
+            if self._scanned < os.fstat(self._fd).st_size:
+                os.ftruncate(self._fd, self._scanned)
+            offset = self._scanned
+            os.lseek(self._fd, offset, os.SEEK_SET)
+            os.write(self._fd, record)
+            os.fsync(self._fd)
+            self._refresh()
+        return offset
+
+    def names(self):
+        with self._lock, self._file_lock(shared=True):
+            self._refresh()
+            return list(self._index)
+
+    def close(self):
+        with self._lock:
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+            os.close(self._fd)
+
+
+class _FileLock:
+    # flock for the duration of a with-block: exclusive for appends, shared for scans (a no-op without fcntl)
+    def __init__(self, fd, shared=False):
+        self._fd = fd
+        self._shared = shared
+
+    def __enter__(self):
+        if fcntl is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_SH if self._shared else fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if fcntl is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        return False
+
+
+_keystore = None
+_keystore_lock = threading.Lock()
+
+
+def get_keystore():
+    # Opened on first use, so the key-encryption key is derived once per process.
+    # None when KEYSTORE_PASSPHRASE isn't set: private keys then stay in per-user PEM files.
+    global _keystore
+    if not KEYSTORE_PASSPHRASE:
+        return None
+    if _keystore is None:
+        with _keystore_lock:
+            if _keystore is None:
+                _keystore = Keystore()
+    return _keystore
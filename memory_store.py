@@ -0,0 +1,474 @@
+# In-process stand-in for the subset of the Firestore client API this app uses:
+# collections, documents, where/order_by/start_after/limit queries, get_all,
+# write batches, transactions, on_snapshot listeners and the field transforms
+# (ArrayUnion, ArrayRemove, DELETE_FIELD, SERVER_TIMESTAMP). Selected with STORAGE_BACKEND=memory so the
+# app and benchmarks can run without a Firebase project or network.
+import copy
+import datetime
+import enum
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+class NotFound(Exception):
+    pass
+
+
+class ArrayUnion:
+    def __init__(self, values):
+        self.values = list(values)
+
+
+class ArrayRemove:
+    def __init__(self, values):
+        self.values = list(values)
+
+
+class _Sentinel:
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return self.name
+
+    def __deepcopy__(self, memo):
+        # Sentinels are compared by identity, so copies must be the same object
+        return self
+
+
+DELETE_FIELD = _Sentinel('DELETE_FIELD')
+SERVER_TIMESTAMP = _Sentinel('SERVER_TIMESTAMP')
+
+
+class ChangeType(enum.Enum):
+    ADDED = 1
+    REMOVED = 2
+    MODIFIED = 3
+
+
+class DocumentChange:
+    def __init__(self, change_type, document):
+        self.type = change_type
+        self.document = document
+
+
+class Watch:
+    # Re-runs its query after every write to the collection and reports the difference,
+    # delivering callbacks on the client's watch thread like Firestore does
+
+    def __init__(self, query, callback):
+        self._query = query
+        self._callback = callback
+        self._documents = None
+        self._active = True
+
+    def _refresh(self):
+        # Called with the client lock held
+        current = {snapshot.id: snapshot for snapshot in self._query.get()}
+        previous = self._documents or {}
+        changes = [
+            DocumentChange(ChangeType.ADDED if doc_id not in previous else ChangeType.MODIFIED, snapshot)
+            for doc_id, snapshot in current.items()
+            if doc_id not in previous or previous[doc_id]._data != snapshot._data
+        ]
+        changes += [DocumentChange(ChangeType.REMOVED, snapshot) for doc_id, snapshot in previous.items() if doc_id not in current]
+        first = self._documents is None
+        self._documents = current
+        if changes or first:
+            self._query._client._watch_executor.submit(self._deliver, list(current.values()), changes, _now())
+
+    def _deliver(self, snapshots, changes, read_time):
+        if self._active:
+            self._callback(snapshots, changes, read_time)
+
+    def unsubscribe(self):
+        self._active = False
+        self._query._client._remove_watch(self)
+
+
+class Query:
+    ASCENDING = 'ASCENDING'
+    DESCENDING = 'DESCENDING'
+
+    def __init__(self, client, collection_name, filters=(), orders=(), cursor=None, limit_count=None):
+        self._client = client
+        self._collection_name = collection_name
+        self._filters = tuple(filters)
+        self._orders = tuple(orders)
+        self._cursor = cursor
+        self._limit = limit_count
+
+    def _copy(self, **changes):
+        fields = {
+            'filters': self._filters,
+            'orders': self._orders,
+            'cursor': self._cursor,
+            'limit_count': self._limit,
+        }
+        fields.update(changes)
+        return Query(self._client, self._collection_name, **fields)
+
+    def where(self, field, op, value):
+        if op not in _OPERATORS:
+            raise ValueError(f"Unsupported operator: {op}")
+        return self._copy(filters=self._filters + ((field, op, value),))
+
+    def order_by(self, field, direction=ASCENDING):
+        return self._copy(orders=self._orders + ((field, direction),))
+
+    def limit(self, count):
+        return self._copy(limit_count=count)
+
+    def start_after(self, values):
+        # Accepts a snapshot, a {field: value} dict or a list of values in order_by order
+        if isinstance(values, DocumentSnapshot):
+            values = {field: _order_value(values.id, values._data, field) for field, _ in self._orders}
+        if isinstance(values, dict):
+            values = [values[field] for field, _ in self._orders]
+        return self._copy(cursor=list(values))
+
+    def _matches(self, doc_id, data):
+        for field, op, value in self._filters:
+            found, field_value = _lookup(data, field)
+            if not found or not _OPERATORS[op](field_value, value):
+                return False
+        # Firestore leaves out documents that lack an order_by field
+        for field, _ in self._orders:
+            if field != '__name__' and not _lookup(data, field)[0]:
+                return False
+        return True
+
+    def _sort_key(self, doc_id, data):
+        return [_type_order(_order_value(doc_id, data, field)) for field, _ in self._orders]
+
+    def _after_cursor(self, doc_id, data):
+        for (field, direction), cursor_value in zip(self._orders, self._cursor):
+            value = _type_order(_order_value(doc_id, data, field))
+            cursor_value = _type_order(cursor_value)
+            if value == cursor_value:
+                continue
+            if direction == Query.DESCENDING:
+                return value < cursor_value
+            return value > cursor_value
+        return False  # Equal on every order field: this is the cursor document itself
+
+    def stream(self, transaction=None):
+        with self._client._lock:
+            documents = [
+                (doc_id, copy.deepcopy(data))
+                for doc_id, data in self._client._collection(self._collection_name).items()
+                if self._matches(doc_id, data)
+            ]
+
+        # Stable sorts applied from the last order_by to the first give a multi-key sort
+        # with per-field directions; document id is the final tiebreak like in Firestore
+        documents.sort(key=lambda item: item[0])
+        for index in reversed(range(len(self._orders))):
+            field, direction = self._orders[index]
+            documents.sort(key=lambda item: self._sort_key(*item)[index], reverse=direction == Query.DESCENDING)
+
+        if self._cursor is not None:
+            documents = [item for item in documents if self._after_cursor(*item)]
+        if self._limit is not None:
+            documents = documents[:self._limit]
+
+        for doc_id, data in documents:
+            yield DocumentSnapshot(DocumentReference(self._client, self._collection_name, doc_id), data)
+
+    def get(self, transaction=None):
+        return list(self.stream(transaction))
+
+    def on_snapshot(self, callback):
+        return self._client._add_watch(Watch(self, callback))
+
+
+class CollectionReference(Query):
+    def __init__(self, client, name):
+        super().__init__(client, name)
+        self.id = name
+
+    def document(self, document_id=None):
+        return DocumentReference(self._client, self._collection_name, document_id or uuid.uuid4().hex[:20])
+
+    def add(self, data, document_id=None):
+        doc_ref = self.document(document_id)
+        doc_ref.create(data)
+        return _now(), doc_ref
+
+
+class DocumentReference:
+    def __init__(self, client, collection_name, document_id):
+        self._client = client
+        self._collection_name = collection_name
+        self.id = document_id
+        self.path = f"{collection_name}/{document_id}"
+
+    def __eq__(self, other):
+        return isinstance(other, DocumentReference) and other.path == self.path
+
+    def __hash__(self):
+        return hash(self.path)
+
+    def get(self, transaction=None):
+        with self._client._lock:
+            data = self._client._collection(self._collection_name).get(self.id)
+            return DocumentSnapshot(self, copy.deepcopy(data))
+
+    def create(self, data):
+        with self._client._lock:
+            if self.id in self._client._collection(self._collection_name):
+                raise ValueError(f"Document already exists: {self.path}")
+            self._client._write(self, 'set', data)
+
+    def set(self, data, merge=False):
+        with self._client._lock:
+            self._client._write(self, 'merge' if merge else 'set', data)
+
+    def update(self, data):
+        with self._client._lock:
+            self._client._write(self, 'update', data)
+
+    def delete(self):
+        with self._client._lock:
+            self._client._write(self, 'delete', None)
+
+
+class DocumentSnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+
+    @property
+    def exists(self):
+        return self._data is not None
+
+    def to_dict(self):
+        return copy.deepcopy(self._data)
+
+    def get(self, field):
+        found, value = _lookup(self._data or {}, field)
+        if not found:
+            raise KeyError(field)
+        return copy.deepcopy(value)
+
+
+class WriteBatch:
+    def __init__(self, client):
+        self._client = client
+        self._writes = []
+
+    def create(self, doc_ref, data):
+        self._writes.append((doc_ref, 'create', data))
+
+    def set(self, doc_ref, data, merge=False):
+        self._writes.append((doc_ref, 'merge' if merge else 'set', data))
+
+    def update(self, doc_ref, data):
+        self._writes.append((doc_ref, 'update', data))
+
+    def delete(self, doc_ref):
+        self._writes.append((doc_ref, 'delete', None))
+
+    def commit(self):
+        # All-or-nothing, like a Firestore batch: check every write before applying any
+        with self._client._lock:
+            exists = {}
+            for doc_ref, kind, _ in self._writes:
+                present = exists.get(doc_ref.path)
+                if present is None:
+                    present = doc_ref.id in self._client._collection(doc_ref._collection_name)
+                if kind == 'create' and present:
+                    raise ValueError(f"Document already exists: {doc_ref.path}")
+                if kind == 'update' and not present:
+                    raise NotFound(f"No document to update: {doc_ref.path}")
+                exists[doc_ref.path] = kind != 'delete'
+
+            for doc_ref, kind, data in self._writes:
+                self._client._write(doc_ref, 'set' if kind == 'create' else kind, data)
+        self._writes = []
+
+
+class Transaction(WriteBatch):
+    # Reads and writes run under the client lock, so a transaction never has to retry
+    pass
+
+
+def transactional(fn):
+    def run(transaction, *args, **kwargs):
+        with transaction._client._lock:
+            result = fn(transaction, *args, **kwargs)
+            transaction.commit()
+            return result
+    return run
+
+
+class MemoryClient:
+    def __init__(self):
+        self._collections = {}
+        self._lock = threading.RLock()
+        self._watches = []
+        self._watch_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='memory-watch')
+
+    def _collection(self, name):
+        return self._collections.setdefault(name, {})
+
+    def collection(self, name):
+        return CollectionReference(self, name)
+
+    def get_all(self, references, transaction=None):
+        return [doc_ref.get() for doc_ref in references]
+
+    def batch(self):
+        return WriteBatch(self)
+
+    def transaction(self):
+        return Transaction(self)
+
+    def reset(self):
+        with self._lock:
+            self._collections = {}
+            for watch in self._watches:
+                watch._active = False
+            self._watches = []
+
+    def _add_watch(self, watch):
+        with self._lock:
+            self._watches.append(watch)
+            watch._refresh()
+        return watch
+
+    def _remove_watch(self, watch):
+        with self._lock:
+            if watch in self._watches:
+                self._watches.remove(watch)
+
+    def _notify(self, collection_name):
+        for watch in list(self._watches):
+            if watch._query._collection_name == collection_name:
+                watch._refresh()
+
+    def _write(self, doc_ref, kind, data):
+        documents = self._collection(doc_ref._collection_name)
+        if kind == 'delete':
+            documents.pop(doc_ref.id, None)
+            self._notify(doc_ref._collection_name)
+            return
+        if kind == 'update' and doc_ref.id not in documents:
+            raise NotFound(f"No document to update: {doc_ref.path}")
+
+        if kind == 'set':
+            document = {}
+        else:
+            document = documents.get(doc_ref.id, {})
+
+        if kind == 'merge':
+            _merge(document, copy.deepcopy(data))
+        else:
+            for field, value in data.items():
+                # update() takes dotted field paths; set() takes plain keys
+                _apply(document, field.split('.') if kind == 'update' else [field], copy.deepcopy(value))
+        documents[doc_ref.id] = _resolve_transforms(document)
+        self._notify(doc_ref._collection_name)
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def _lookup(data, field):
+    value = data
+    for part in field.split('.'):
+        if not isinstance(value, dict) or part not in value:
+            return False, None
+        value = value[part]
+    return True, value
+
+
+def _order_value(doc_id, data, field):
+    if field == '__name__':
+        return doc_id
+    return _lookup(data, field)[1]
+
+
+def _apply(document, path, value):
+    parent = document
+    for part in path[:-1]:
+        parent = parent.setdefault(part, {})
+    key = path[-1]
+    if value is DELETE_FIELD:
+        parent.pop(key, None)
+    elif isinstance(value, ArrayUnion):
+        current = list(parent.get(key) or [])
+        parent[key] = current + [item for item in value.values if item not in current]
+    elif isinstance(value, ArrayRemove):
+        parent[key] = [item for item in parent.get(key) or [] if item not in value.values]
+    else:
+        parent[key] = value
+
+
+def _merge(document, data):
+    for key, value in data.items():
+        if isinstance(value, dict) and isinstance(document.get(key), dict):
+            _merge(document[key], value)
+        else:
+            _apply(document, [key], value)
+
+
+def _resolve_transforms(value):
+    if value is SERVER_TIMESTAMP:
+        return _now()
+    if isinstance(value, dict):
+        return {key: _resolve_transforms(item) for key, item in value.items()}
+    return value
+
+
+# Firestore orders values of different types by type first
+_TYPE_RANKS = [
+    (type(None), 0),
+    (bool, 1),
+    ((int, float), 2),
+    (datetime.datetime, 3),
+    (str, 4),
+    (bytes, 5),
+    (DocumentReference, 6),
+    (list, 8),
+    (dict, 9),
+]
+
+
+def _type_order(value):
+    if isinstance(value, DocumentReference):
+        return (6, value.path)
+    for types, rank in _TYPE_RANKS:
+        if isinstance(value, types):
+            if isinstance(value, datetime.datetime) and value.tzinfo is None:
+                value = value.replace(tzinfo=datetime.timezone.utc)
+            if isinstance(value, (list, dict)):
+                return (rank, repr(value))
+            return (rank, value)
+    return (10, repr(value))
+
+
+def _compare(op):
+    def check(field_value, value):
+        left, right = _type_order(field_value), _type_order(value)
+        if left[0] != right[0]:
+            return False  # Range filters only match values of the same type
+        return op(left, right)
+    return check
+
+
+_OPERATORS = {
+    '==': lambda field_value, value: field_value == value,
+    '!=': lambda field_value, value: field_value != value,
+    '<': _compare(lambda left, right: left < right),
+    '<=': _compare(lambda left, right: left <= right),
+    '>': _compare(lambda left, right: left > right),
+    '>=': _compare(lambda left, right: left >= right),
+    'in': lambda field_value, values: field_value in values,
+    'not-in': lambda field_value, values: field_value not in values,
+    'array_contains': lambda field_value, value: isinstance(field_value, list) and value in field_value,
+    'array_contains_any': lambda field_value, values: isinstance(field_value, list) and any(v in field_value for v in values),
+}
@@ -0,0 +1,222 @@
+# Process-wide timing and Firestore usage metrics.
+# `timed(name)` works as a decorator or a context manager and records call counts and a
+# latency histogram per operation. Firestore document reads and writes (counted by the
+# instrumented client in firestore_metrics) are charged to every timed operation running
+# on the current thread, so a page render reports the reads of everything it called.
+# Page renders also emit one structured JSON log line each.
+#
+# Components with their own state (e.g. the key pool) register a gauge collector, read at export time.
+#
+# Export: render_prometheus() gives the Prometheus text format, served over HTTP by
+# start_metrics_server() when METRICS_PORT is set; snapshot() gives the same data as a dict.
+import contextlib
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_timings = {}  # operation -> {'count', 'sum', 'buckets': [...]}
+_reads = {}    # operation -> documents read
+_writes = {}   # operation -> documents written
+_gauge_collectors = {}  # component -> function returning {gauge name: number}
+_local = threading.local()
+
+
+def _active_scopes():
+    if not hasattr(_local, 'scopes'):
+        _local.scopes = []
+    return _local.scopes
+
+
+class _Scope:
+    def __init__(self, name, log):
+        self.name = name
+        self.log = log
+        self.reads = 0
+        self.writes = 0
+
+
+def observe(name, seconds):
+    with _lock:
+        timing = _timings.get(name)
+        if timing is None:
+            timing = _timings[name] = {'count': 0, 'sum': 0.0, 'buckets': [0] * len(LATENCY_BUCKETS)}
+        timing['count'] += 1
+        timing['sum'] += seconds
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                timing['buckets'][index] += 1
+                break
+
+
+def _charge(totals, attribute, operation, count):
+    # Charge to the Firestore operation itself and to every timed operation enclosing it
+    names = {operation} | {scope.name for scope in _active_scopes()}
+    with _lock:
+        for name in names:
+            totals[name] = totals.get(name, 0) + count
+    for scope in _active_scopes():
+        setattr(scope, attribute, getattr(scope, attribute) + count)
+
+
+def count_reads(operation, documents):
+    _charge(_reads, 'reads', operation, documents)
+
+
+def count_writes(operation, documents):
+    _charge(_writes, 'writes', operation, documents)
+
+
+class timed(contextlib.ContextDecorator):
+    # @timed('crypto.seal_envelope') or `with timed('firestore.posts.get'):`
+    # log=True also writes a JSON line per call with its duration, reads and writes
+
+    def __init__(self, name, log=False):
+        self.name = name
+        self.log = log
+
+    def __enter__(self):
+        scopes = _active_scopes()
+        scopes.append(_Scope(self.name, self.log))
+        scopes[-1].start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        scope = _active_scopes().pop()
+        seconds = time.perf_counter() - scope.start
+        observe(self.name, seconds)
+        if scope.log:
+            logger.info(json.dumps({
+                'operation': self.name,
+                'seconds': round(seconds, 6),
+                'reads': scope.reads,
+                'writes': scope.writes,
+                'error': exc_type.__name__ if exc_type else None,
+            }))
+        return False
+
+    def __call__(self, fn):
+        # A fresh scope per call, so the decorator is safe across threads and recursion
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timed(self.name, self.log):
+                return fn(*args, **kwargs)
+        return wrapper
+
+
+def register_gauges(component, collect):
+    # collect() is called on every export and returns current values, e.g. {'depth': 12}
+    with _lock:
+        _gauge_collectors[component] = collect
+
+
+def _collect_gauges(collectors):
+    gauges = {}
+    for component, collect in sorted(collectors.items()):
+        try:
+            values = collect()
+        except Exception:
+            logger.exception("Collecting %s gauges failed", component)
+            continue
+        gauges[component] = {name: value for name, value in values.items() if isinstance(value, (int, float))}
+    return gauges
+
+
+def snapshot():
+    with _lock:
+        data = {
+            'timings': {name: dict(timing, buckets=list(timing['buckets'])) for name, timing in _timings.items()},
+            'reads': dict(_reads),
+            'writes': dict(_writes),
+        }
+        collectors = dict(_gauge_collectors)
+    # Collectors take their own locks, so they run outside this one
+    data['gauges'] = _collect_gauges(collectors)
+    return data
+
+
+def reset_metrics():
+    with _lock:
+        _timings.clear()
+        _reads.clear()
+        _writes.clear()
+
+
+def _label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def render_prometheus():
+    data = snapshot()
+    lines = [
+        '# HELP app_operation_seconds Time spent in instrumented operations.',
+        '# TYPE app_operation_seconds histogram',
+    ]
+    for name, timing in sorted(data['timings'].items()):
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS, timing['buckets']):
+            cumulative += count
+            lines.append(f'app_operation_seconds_bucket{{operation="{_label(name)}",le="{bound}"}} {cumulative}')
+        lines.append(f'app_operation_seconds_bucket{{operation="{_label(name)}",le="+Inf"}} {timing["count"]}')
+        lines.append(f'app_operation_seconds_sum{{operation="{_label(name)}"}} {timing["sum"]:.6f}')
+        lines.append(f'app_operation_seconds_count{{operation="{_label(name)}"}} {timing["count"]}')
+
+    for metric, key, help_text in (
+        ('app_firestore_documents_read_total', 'reads', 'Firestore documents read, by operation.'),
+        ('app_firestore_documents_written_total', 'writes', 'Firestore documents written, by operation.'),
+    ):
+        lines.append(f'# HELP {metric} {help_text}')
+        lines.append(f'# TYPE {metric} counter')
+        for name, count in sorted(data[key].items()):
+            lines.append(f'{metric}{{operation="{_label(name)}"}} {count}')
+
+    for component, gauges in data['gauges'].items():
+        for name, value in sorted(gauges.items()):
+            metric = f'app_{component}_{name}'
+            lines.append(f'# TYPE {metric} gauge')
+            lines.append(f'{metric} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/metrics':
+            body, content_type = render_prometheus().encode(), 'text/plain; version=0.0.4'
+        elif self.path == '/metrics.json':
+            body, content_type = json.dumps(snapshot()).encode(), 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Scrapes would otherwise flood stderr
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def start_metrics_server(port=METRICS_PORT):
+    # Serves /metrics (Prometheus) and /metrics.json; safe to call on every Streamlit rerun
+    global _server
+    with _server_lock:
+        if _server is None and port:
+            _server = ThreadingHTTPServer(('', port), _MetricsHandler)
+            threading.Thread(target=_server.serve_forever, name='metrics-server', daemon=True).start()
+        return _server
@@ -0,0 +1,76 @@
+# Imports the per-user private key PEM files in keys/ into the keystore (see keystore.py).
+# Safe to stop and re-run: only keys the keystore doesn't hold yet are imported. A key the
+# keystore already holds is never overwritten; if its PEM file differs it is reported and kept.
+# With --delete each PEM file is removed once the keystore provably returns the same key.
+# Usage: KEYSTORE_PASSPHRASE=... python migrate_keystore.py [--keys-dir keys] [--delete]
+import argparse
+import os
+from cryptography.hazmat.primitives import serialization
+from keystore import get_keystore, key_entry_name
+
+PEM_SUFFIX = '_private_key.pem'
+KEY_KINDS = ('x25519', 'ed25519')  # RSA keys have no kind in their file name
+
+
+def parse_key_file_name(file_name):
+    # '<uid>_private_key.pem' -> (uid, 'rsa'); '<uid>_<kind>_private_key.pem' -> (uid, kind)
+    stem = file_name[:-len(PEM_SUFFIX)]
+    for kind in KEY_KINDS:
+        if stem.endswith('_' + kind):
+            return stem[:-len(kind) - 1], kind
+    return stem, 'rsa'
+
+
+def pem_to_der(pem):
+    private_key = serialization.load_pem_private_key(pem, password=None)
+    return private_key.private_bytes(
+        encoding=serialization.Encoding.DER,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption()
+    )
+
+
+def migrate(keys_dir='keys', delete=False):
+    keystore = get_keystore()
+    if keystore is None:
+        raise SystemExit("Set KEYSTORE_PASSPHRASE to the passphrase the keystore should be encrypted with")
+    imported = skipped = conflicts = deleted = 0
+
+    for file_name in sorted(os.listdir(keys_dir)):
+        if not file_name.endswith(PEM_SUFFIX):
+            continue
+        path = os.path.join(keys_dir, file_name)
+        uid, kind = parse_key_file_name(file_name)
+        entry_name = key_entry_name(uid, kind)
+        with open(path, 'rb') as f:
+            der = pem_to_der(f.read())
+
+        if keystore.locate(entry_name) is None:
+            keystore.put(entry_name, der)
+            imported += 1
+        elif keystore.read(entry_name) == der:
+            skipped += 1
+        else:
+            # The keystore copy was stored after the PEM (e.g. a key rotation since the app
+            # switched to the keystore): keep it, and keep the PEM for someone to look at
+            print(f"Kept the keystore's {entry_name} key: it differs from {path}")
+            conflicts += 1
+            continue
+
+        if delete:
+            # Only remove the file once the keystore provably returns the same key
+            if keystore.read(entry_name) != der:
+                raise RuntimeError(f"Keystore did not return the key imported from {path}")
+            os.remove(path)
+            deleted += 1
+
+    print(f"Done. Imported {imported} keys, {skipped} already present, {conflicts} differing and left alone, "
+          f"deleted {deleted} PEM files")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Import per-user private key PEM files into the keystore")
+    parser.add_argument('--keys-dir', default='keys')
+    parser.add_argument('--delete', action='store_true', help="remove each PEM file after importing it")
+    args = parser.parse_args()
+    migrate(args.keys_dir, args.delete)
@@ -0,0 +1,70 @@
+# Backfills native Firestore timestamps on posts written with the old
+# "%d-%m-%Y %H:%M:%S" string format. Safe to stop and re-run: progress is
+# checkpointed after every committed batch and converted posts are skipped.
+# Usage: python migrate_timestamps.py [--batch-size N] [--restart]
+import argparse
+import datetime
+import os
+from firestore_batch import BATCH_WRITE_LIMIT, BatchWriter
+from storage import db
+
+LEGACY_TIMESTAMP_FORMAT = "%d-%m-%Y %H:%M:%S"
+CHECKPOINT_FILE = '.migrate_timestamps_checkpoint'
+
+
+def parse_legacy_timestamp(value):
+    # Legacy strings were written in the server's local time
+    return datetime.datetime.strptime(value, LEGACY_TIMESTAMP_FORMAT).astimezone()
+
+
+def read_checkpoint():
+    if not os.path.exists(CHECKPOINT_FILE):
+        return None
+    with open(CHECKPOINT_FILE) as f:
+        return f.read().strip() or None
+
+
+def write_checkpoint(post_id):
+    with open(CHECKPOINT_FILE, 'w') as f:
+        f.write(post_id)
+
+
+def migrate(batch_size=BATCH_WRITE_LIMIT):
+    posts_ref = db.collection('posts')
+    last_post_id = read_checkpoint()
+    scanned = converted = 0
+
+    while True:
+        # Walk the collection in document id order so a checkpoint is just the last id seen
+        query = posts_ref.order_by('__name__').limit(batch_size)
+        if last_post_id is not None:
+            query = query.start_after({'__name__': last_post_id})
+        posts = list(query.stream())
+        if not posts:
+            break
+
+        with BatchWriter('migrate_timestamps') as writer:
+            for post in posts:
+                timestamp = post.to_dict().get('timestamp')
+                if isinstance(timestamp, str):
+                    writer.update(posts_ref.document(post.id), {'timestamp': parse_legacy_timestamp(timestamp)})
+                    converted += 1
+        scanned += len(posts)
+        last_post_id = posts[-1].id
+        write_checkpoint(last_post_id)
+        print(f"Scanned {scanned} posts, converted {converted}")
+
+    # Finished: the next run starts from the beginning again
+    if os.path.exists(CHECKPOINT_FILE):
+        os.remove(CHECKPOINT_FILE)
+    print(f"Done. Scanned {scanned} posts, converted {converted}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert string post timestamps to native Firestore timestamps")
+    parser.add_argument('--batch-size', type=int, default=BATCH_WRITE_LIMIT)
+    parser.add_argument('--restart', action='store_true', help="ignore any saved checkpoint")
+    args = parser.parse_args()
+    if args.restart and os.path.exists(CHECKPOINT_FILE):
+        os.remove(CHECKPOINT_FILE)
+    migrate(min(args.batch_size, BATCH_WRITE_LIMIT))
@@ -1,9 +1,112 @@
 import streamlit as st                                                                                                                                                                        
-from encrypt_decrypt import decrypt_message_with_private_key
-from firebase_admin_utils import authenticate_user, db, create_user, save_user_details
+from firebase_admin_utils import authenticate_user, db, create_user, get_usernames, save_user_details
+from metrics import timed
 from group_utils import create_group, add_user_to_group, remove_user_from_group, get_group_posts
-from post_utils import create_post, delete_post, get_excluded_user_ids, get_user_posts, get_recent_posts
+from attachments import iter_attachment
+from feed_cache import FEED_CACHE_TTL, posts_generation, user_generation
+from feed_listener import FeedListener
+from reencrypt_jobs import job_throughput, list_jobs, retry_job
+from post_utils import create_post, decrypt_post, decrypt_posts, delete_post, format_ciphertext, format_timestamp, get_excluded_user_ids, get_user_posts, get_recent_posts, post_data_keys
 
+def store_decrypted_posts(posts, user_id):
+    # Keep bulk results under the same session keys the per-post Decrypt buttons use
+    for post_id, decrypted_text in decrypt_posts(posts, user_id).items():
+        st.session_state[f"decrypt_{post_id}"] = decrypted_text or "You don't have a key for this post."
+
+# Per-session caches, dropped on logout
+SESSION_CACHE_KEYS = ('feed_listener', 'group_feed', 'my_posts_feed', 'explore_feed', 'user_group_ids', 'group_epoch_keys')
+
+def clear_session_caches(*keys):
+    if not keys:
+        # Full reset (logout) also forgets every decrypted post
+        keys = SESSION_CACHE_KEYS + tuple(key for key in st.session_state if key.startswith("decrypt_"))
+    for key in keys:
+        value = st.session_state.pop(key, None)
+        if isinstance(value, FeedListener):
+            value.close()  # Stop its snapshot listeners
+
+def get_feed_listener(user_id):
+    # One live group feed per session, replaced if a different user logs in or it was
+    # closed for being idle (see feed_listener)
+    listener = st.session_state.get('feed_listener')
+    if listener is None or listener.user_id != user_id or listener.closed:
+        if listener is not None:
+            listener.close()
+        listener = FeedListener(user_id)
+        st.session_state['feed_listener'] = listener
+    return listener
+
+# Attachments larger than this are offered as a download instead of shown inline
+ATTACHMENT_PREVIEW_LIMIT = 20 * 1024 * 1024
+
+def post_data_key(post, user_id):
+    # Kept next to the post's decrypted text (and forgotten with it on logout), so showing
+    # attachments doesn't unwrap the post key again on every rerun
+    key_name = f"decrypt_{post['post_id']}_key"
+    if key_name not in st.session_state:
+        st.session_state[key_name] = post_data_keys([post], user_id)[post['post_id']]
+    return st.session_state[key_name]
+
+def show_attachments(post, user_id):
+    # Each attachment is only read and decrypted when its button is clicked, and only for that
+    # run: Streamlit needs the whole file in memory to render it, so it isn't kept between reruns
+    for attachment in post.get('attachments', []):
+        content_type = attachment.get('type') or 'file'
+        if attachment['size'] > ATTACHMENT_PREVIEW_LIMIT:
+            st.write(f"Attachment too large to preview ({attachment['size'] // (1024 * 1024)} MB)")
+            continue
+        label = f"Show attachment ({content_type}, {max(1, attachment['size'] // 1024)} KB)"
+        if not st.button(label, key=f"show_{attachment['id']}"):
+            continue
+        data_key = post_data_key(post, user_id)
+        if data_key is None:
+            return
+        data = b''.join(iter_attachment(attachment, data_key))
+        if content_type.startswith('image/'):
+            st.image(data)
+        elif content_type.startswith('video/'):
+            st.video(data)
+        else:
+            st.download_button("Download attachment", data, key=f"download_{attachment['id']}")
+
+# Feed pages shared by every session in this process. The generation arguments only key the
+# cache: writes bump them (see feed_cache), so reruns without writes cost no Firestore reads.
+@st.cache_data(ttl=FEED_CACHE_TTL, show_spinner=False)
+def cached_group_posts(user_id, cursor, generation):
+    return get_group_posts(user_id, cursor=cursor)
+
+@st.cache_data(ttl=FEED_CACHE_TTL, show_spinner=False)
+def cached_user_posts(user_id, cursor, generation):
+    return get_user_posts(user_id, cursor=cursor)
+
+@st.cache_data(ttl=FEED_CACHE_TTL, show_spinner=False)
+def cached_excluded_user_ids(user_id, generation):
+    return get_excluded_user_ids(user_id)
+
+@st.cache_data(ttl=FEED_CACHE_TTL, show_spinner=False)
+def cached_recent_posts(user_id, cursor, generation):
+    exclude_user_ids = cached_excluded_user_ids(user_id, generation[0])
+    return get_recent_posts(exclude_user_ids=exclude_user_ids, cursor=cursor)
+
+def load_feed(state_key, fetch_page, generation):
+    # Loaded pages are kept in session state, so reruns don't re-read history;
+    # they are reloaded from the first page once a write changes the generation
+    feed = st.session_state.get(state_key)
+    if feed is None or feed['generation'] != generation:
+        posts, cursor = fetch_page(None)
+        feed = {'posts': posts, 'cursor': cursor, 'generation': generation}
+        st.session_state[state_key] = feed
+    return feed
+
+def load_more_button(state_key, fetch_page):
+    feed = st.session_state[state_key]
+    if feed['cursor'] and st.button("Load more", key=f"{state_key}_load_more"):
+        posts, cursor = fetch_page(feed['cursor'])
+        feed['posts'].extend(posts)
+        feed['cursor'] = cursor
+        st.experimental_rerun()
+
+@timed('page.dashboard_page', log=True)
 def dashboard_page():
     # Ensure the user is logged in
     if 'current_user' not in st.session_state or not st.session_state['current_user']:
@@ -18,17 +121,35 @@ def dashboard_page():
     # Allow the user to create a new post
     with st.form("new_post"):
         post_text = st.text_area("What's happening?")
+        post_attachments = st.file_uploader("Attachments", accept_multiple_files=True)
         submit_post = st.form_submit_button("Post")
         if submit_post and post_text:
-            create_post(user_id, post_text)
+            create_post(user_id, post_text, post_attachments or ())
             st.success("Posted successfully!")
     
     # Display posts from users the current user follows
     st.write("### Posts from people in your groups")
-    posts = get_group_posts(user_id)
-    for post in posts:
-        post_user_details = db.collection('users').document(post['user_id']).get()
-        post_username = post_user_details.to_dict().get('username')
+
+    # The newest page is kept current by snapshot listeners; older pages are read on
+    # demand after it and start over whenever new posts push the live page along
+    live_posts, live_cursor = get_feed_listener(user_id).page()
+    older = st.session_state.get('group_feed')
+    if older is None or older['generation'] != live_cursor:
+        older = {'posts': [], 'cursor': live_cursor, 'generation': live_cursor}
+        st.session_state['group_feed'] = older
+    feed_posts = live_posts + older['posts']
+
+    generation = user_generation(user_id)
+    fetch_page = lambda cursor: cached_group_posts(user_id, cursor, generation)
+
+    # Decrypt every loaded post in one pass instead of one rerun per post
+    if feed_posts and st.button("Decrypt all", key="group_feed_decrypt_all"):
+        store_decrypted_posts(feed_posts, user_id)
+
+    # Resolve every author on the page in one batched read
+    usernames = get_usernames(post['user_id'] for post in feed_posts)
+    for post in feed_posts:
+        post_username = usernames.get(post['user_id'])
     
         # Create a unique key for each post's decryption state
         decrypt_key = f"decrypt_{post['post_id']}"
@@ -38,26 +159,32 @@ def dashboard_page():
             col1, col2 = st.columns([8, 2])
             with col1:
                 st.markdown(f"**Posted by:** {post_username}")
-                st.write(f"Posted at: {post['timestamp']}")
+                st.write(f"Posted at: {format_timestamp(post['timestamp'])}")
             with col2:
-                # Assuming you have a way to properly decode or handle `post['encrypted_text']`
                 if st.button("Decrypt", key=post['post_id']):
-                    decrypted_text = decrypt_message_with_private_key(post['encrypted_text'].decode(), post['encrypted_keys'][user_id], user_id)
+                    decrypted_text = decrypt_post(post, user_id) or "You don't have a key for this post."
                     # Output decrypted text in a new container or adjust layout as needed
                     st.session_state[decrypt_key] = decrypted_text
         
             # Display the encrypted post text in the middle of the container
-            st.write(f"**Encrypted post:** {post['encrypted_text'].decode()}")
+            st.write(f"**Encrypted post:** {format_ciphertext(post)}")
 
             # Check if the decrypted text should be displayed
             if decrypt_key in st.session_state and st.session_state[decrypt_key]:
                 st.write(f"**Decrypted post:** {st.session_state[decrypt_key]}")
+                show_attachments(post, user_id)
 
             st.markdown("---")  # Add a horizontal line for visual separation
 
+    load_more_button('group_feed', fetch_page)
+
 
 # Function to render the signup form
+@timed('page.signup_page', log=True)
 def signup_page():
+    # Start filling the key pool while the user types
+    from key_pool import get_key_pool
+    get_key_pool()
     with st.form("signup_form"):
         st.write("### Sign Up")
         email = st.text_input("Email")
@@ -75,6 +202,7 @@ def signup_page():
                 else:
                     st.error("Failed to save user details.")
 
+@timed('page.login_page', log=True)
 def login_page():
     st.title("Social Media Login Page")
 
@@ -110,6 +238,7 @@ def login_page():
                 st.error("Login Failed. Please check your email and password.")
 
 
+@timed('page.group_management_page', log=True)
 def group_management_page():
     st.title("Group Management")
     
@@ -142,33 +271,64 @@ def group_management_page():
             result = remove_user_from_group(group_name_remove, username_to_remove, st.session_state['current_user']['uid'])
             st.success(result)  # Display the result of the attempt to remove a user
 
+    show_reencrypt_jobs(st.session_state['current_user']['uid'])
+
 
+def show_reencrypt_jobs(admin_id):
+    # Progress of the background re-encryption started by membership changes
+    jobs = list_jobs(admin_id)
+    if not jobs:
+        return
+    st.subheader("Post re-encryption")
+    if st.button("Refresh progress"):
+        st.experimental_rerun()
+    for job in jobs:
+        col1, col2 = st.columns([9, 3])
+        with col1:
+            st.write(f"**{job['kind'].replace('_', ' ').capitalize()}** (job {job['job_id']}): {job['status']}")
+            st.write(f"{job['processed']} posts checked, {job['updated']} updated in {job['batches']} batches "
+                     f"({job_throughput(job):.1f} posts/s)")
+            if job['error']:
+                st.error(job['error'])
+        with col2:
+            if job['status'] == 'failed' and st.button("Retry", key=f"retry_{job['job_id']}"):
+                retry_job(job['job_id'])
+                st.experimental_rerun()
+
+
+@timed('page.my_posts_page', log=True)
 def my_posts_page(user_id):
     st.title("My Posts")
 
-    user_posts = get_user_posts(user_id)
+    generation = user_generation(user_id)
+    fetch_page = lambda cursor: cached_user_posts(user_id, cursor, generation)
+    user_posts = load_feed('my_posts_feed', fetch_page, generation)['posts']
 
     if user_posts:
+        # Decrypt every post in one pass instead of one rerun per post
+        if st.button("Decrypt all", key="my_posts_decrypt_all"):
+            store_decrypted_posts(user_posts, user_id)
+
         for post in user_posts:
             with st.container():
                 # Generate a unique key for decryption button for each post
                 decrypt_key = f"decrypt_{post['post_id']}"
                 
                 # Display the post's encrypted text
-                st.write(f"**Encrypted Post:** {post['encrypted_text'].decode()}")
+                st.write(f"**Encrypted Post:** {format_ciphertext(post)}")
                 
                 # Layout for Post Details and Buttons
                 col1, col2, col3 = st.columns([6,3,3])
                 
                 with col1:
                     # Display the timestamp for each post
-                    st.write(f"Posted at: {post['timestamp']}")
+                    st.write(f"Posted at: {format_timestamp(post['timestamp'])}")
                 
                 with col2:
                     # Button for decrypting the post
                     if st.button("Decrypt", key=f"{post['post_id']}_decrypt"):
-                        # Assuming the decrypt_message_with_private_key function and necessary keys are available
-                        decrypted_text = decrypt_message_with_private_key(post['encrypted_text'].decode(), post['encrypted_keys'][user_id], user_id)
+                        # Decrypt with whichever key this user holds for the post
+                        decrypted_text = decrypt_post(post, user_id) or "You don't have a key for this post."
                         st.session_state[decrypt_key] = decrypted_text
                 
                 with col3:
@@ -180,31 +340,40 @@ def my_posts_page(user_id):
                 # Check if the post has been decrypted and display it
                 if decrypt_key in st.session_state and st.session_state[decrypt_key]:
                     st.write(f"**Decrypted Post:** {st.session_state[decrypt_key]}")
+                    show_attachments(post, user_id)
 
                 st.markdown("---")  # Add a horizontal line for visual separation
+
+        load_more_button('my_posts_feed', fetch_page)
     else:
         st.write("You haven't posted anything yet.")
 
 
+@timed('page.explore_page', log=True)
 def explore_page(user_id):
     st.title("Explore Recent Posts")
 
-    # Get user IDs to exclude: the current user and their group members
-    exclude_user_ids = get_excluded_user_ids(user_id)
+    # Recent posts excluding the current user and their group members, a page at a time
+    generation = (user_generation(user_id), posts_generation())
+    fetch_page = lambda cursor: cached_recent_posts(user_id, cursor, generation)
+    recent_posts = load_feed('explore_feed', fetch_page, generation)['posts']
 
-    # Fetch recent posts excluding those user IDs
-    recent_posts = get_recent_posts(limit=50, exclude_user_ids=exclude_user_ids)
+    if not recent_posts:
+        st.write("No posts from outside your groups yet.")
 
+    # Resolve every author on the page in one batched read
+    usernames = get_usernames(post['user_id'] for post in recent_posts)
     for post in recent_posts:
-        post_user_details = db.collection('users').document(post['user_id']).get()
-        post_username = post_user_details.to_dict().get('username', 'Unknown user')
+        post_username = usernames.get(post['user_id']) or 'Unknown user'
         
         # Create a container for each post with an outline
         with st.container():
             col1, col2 = st.columns([8, 1])
             with col1:
                 st.markdown(f"**Posted by:** {post_username}")
-                st.markdown(f"**Posted at:** {post['timestamp']}")
+                st.markdown(f"**Posted at:** {format_timestamp(post['timestamp'])}")
                 
-            st.write(f"**Encrypted post:** {post['encrypted_text'].decode()}")
-            st.markdown("---")  # Add a horizontal line for visual separation
\ No newline at end of file
+            st.write(f"**Encrypted post:** {format_ciphertext(post)}")
+            st.markdown("---")  # Add a horizontal line for visual separation
+
+    load_more_button('explore_feed', fetch_page)
@@ -1,62 +1,182 @@
+import base64
 import datetime
-from firebase_admin import firestore
-from firebase_admin_utils import db
+from storage import db, firestore
+from audience_index import read_audience
+from feed_cache import invalidate_posts, user_generation
+from firestore_batch import fetch_newest_page, post_cursor
 import streamlit as st
-from group_utils import get_group_member_public_keys, encrypt_for_group_members
+from attachments import delete_attachment, encrypt_attachment
+from cryptography.fernet import Fernet
+from encrypt_decrypt import decrypt_envelope, decrypt_with_symmetric_key, get_wrap_executor, key_id, open_envelope, seal_envelope, unwrap_envelope_for_group, unwrap_symmetric_key
+from group_utils import get_current_group_keys, get_public_keys, load_group_epoch_keys
 
-def create_post(user_id, text):
-    # Add a new post to the "posts" collection
-    posts_ref = db.collection('posts')
-    keys = get_group_member_public_keys(st.session_state['current_user']['uid'])
-    encrypted_msg, encrypted_keys = encrypt_for_group_members(keys, text)
-    posts_ref.add({'user_id': user_id, 'encrypted_text': encrypted_msg, 'encrypted_keys': encrypted_keys, 'timestamp': datetime.datetime.now().strftime("%d-%m-%Y %H:%M:%S")})
+# Number of posts shown per page on My Posts and Explore
+POSTS_PAGE_SIZE = 20
+
+# Explore reads this many posts per query while filling a page, and gives up
+# (leaving a cursor to continue from) after EXPLORE_MAX_READS documents
+EXPLORE_FETCH_SIZE = 50
+EXPLORE_MAX_READS = 500
+
+def get_group_key_cache():
+    # Unwrapped group epoch keys live for the whole session, so each epoch costs one RSA unwrap
+    return st.session_state.setdefault('group_epoch_keys', {})
+
+def get_user_group_ids(user_id):
+    # Envelope group entries only carry hashed group ids, so readers match them against their own groups.
+    # Re-read when a membership change has bumped the user's generation.
+    generation = user_generation(user_id)
+    cached = st.session_state.get('user_group_ids')
+    if cached is None or cached[0] != generation:
+        cached = (generation, list(read_audience(user_id)['groups']))
+        st.session_state['user_group_ids'] = cached
+    return cached[1]
 
-# A function that gets all posts from a specific user
-def get_user_posts(user_id):
+def create_post(user_id, text, attachments=()):
+    # Add a new post to the "posts" collection as a compact envelope, wrapping its key once per group epoch
+    # plus once for the author, who can then still read it after leaving every group.
+    # attachments are file-like objects, streamed into the chunk store under the same post key.
     posts_ref = db.collection('posts')
-    user_posts_query = posts_ref.where('user_id', '==', user_id).order_by('timestamp', direction=firestore.Query.DESCENDING)
-    user_posts = user_posts_query.stream()
+    group_keys = get_current_group_keys(user_id, get_group_key_cache())
+    data_key = Fernet.generate_key()
+    post = {'user_id': user_id, 'timestamp': firestore.SERVER_TIMESTAMP}
+    if attachments:
+        post['attachments'] = [
+            encrypt_attachment(attachment, data_key, getattr(attachment, 'type', None))
+            for attachment in attachments
+        ]
+    post['envelope'] = seal_envelope(
+        text, member_public_keys=get_public_keys([user_id]), group_epoch_keys=group_keys, data_key=data_key
+    )
+    posts_ref.add(post)
+    invalidate_posts(get_excluded_user_ids(user_id))
 
-    user_posts_list = []
-    for post in user_posts:
-        post_data = post.to_dict()
-        post_data['post_id'] = post.id  # Store Firestore document ID to identify the post for deletion
-        user_posts_list.append(post_data)
+def format_timestamp(timestamp):
+    # Posts written before the timestamp migration still carry the old string format
+    if isinstance(timestamp, datetime.datetime):
+        return timestamp.astimezone().strftime("%d-%m-%Y %H:%M:%S")
+    return timestamp
 
-    return user_posts_list
+def format_ciphertext(post):
+    # Text shown as the "Encrypted post" for envelope and legacy Fernet posts alike
+    if 'envelope' in post:
+        return base64.b64encode(open_envelope(post['envelope']).ciphertext).decode()
+    return post['encrypted_text'].decode()
 
-def get_excluded_user_ids(user_id):
-    groups_ref = db.collection('groups')
-    groups = groups_ref.where('members', 'array_contains', user_id).get()
+def decrypt_post(post, user_id):
+    # Returns the plaintext, or None if user_id holds no key for this post
+    return decrypt_posts([post], user_id)[post['post_id']]
+
+def post_data_keys(posts, user_id):
+    # Resolve the data key of every post on a page in one pass; returns {post_id: data key or None}.
+    # Handles envelopes and legacy per-member Fernet posts.
+    data_keys = {}
+    key_cache = get_group_key_cache()
+    envelopes = {post['post_id']: open_envelope(post['envelope']) for post in posts if 'envelope' in post}
+    group_ids = {key_id(group_id): group_id for group_id in get_user_group_ids(user_id)} if envelopes else {}
+
+    def envelope_group_epochs(envelope):
+        for entry_key_id, (epoch, _) in envelope.group_entries.items():
+            if entry_key_id in group_ids:
+                yield group_ids[entry_key_id], epoch
+
+    # Group epoch keys needed by this page: each distinct (group, epoch) key is unwrapped once
+    needed = set()
+    for post in posts:
+        if post['post_id'] in envelopes:
+            needed.update(envelope_group_epochs(envelopes[post['post_id']]))
+    load_group_epoch_keys(needed, user_id, key_cache)
 
-    excluded_user_ids = set([user_id])  # Start with the current user's ID
-    for group in groups:
-        members = group.to_dict().get('members', [])
-        excluded_user_ids.update(members)
+    # Posts wrapped directly for this user are collected and unwrapped together below
+    member_wraps = []
+    own_key_id = key_id(user_id)
+    for post in posts:
+        post_id = post['post_id']
+        if post_id in envelopes:
+            envelope = envelopes[post_id]
+            for group_id, epoch in envelope_group_epochs(envelope):
+                group_key = key_cache.get((group_id, epoch))
+                if group_key is not None:
+                    data_keys[post_id] = unwrap_envelope_for_group(envelope, group_id, group_key)
+                    break
+            else:
+                if own_key_id in envelope.member_entries:
+                    member_wraps.append((post_id, bytes(envelope.member_entries[own_key_id])))
+        elif user_id in post.get('encrypted_keys', {}):
+            member_wraps.append((post_id, post['encrypted_keys'][user_id]))
 
-    return excluded_user_ids
+    # One RSA/X25519 unwrap each with the (cached) private key, spread over the worker pool
+    symmetric_keys = get_wrap_executor().map(lambda item: unwrap_symmetric_key(item[1], user_id), member_wraps)
+    for (post_id, _), symmetric_key in zip(member_wraps, symmetric_keys):
+        data_keys[post_id] = symmetric_key
 
+    for post in posts:
+        data_keys.setdefault(post['post_id'], None)
+    return data_keys
 
-def get_recent_posts(limit=50, exclude_user_ids=None):
+def decrypt_posts(posts, user_id):
+    # Decrypt a whole page of posts in one pass; returns {post_id: plaintext or None}
+    results = {}
+    data_keys = post_data_keys(posts, user_id)
+    for post in posts:
+        data_key = data_keys[post['post_id']]
+        if data_key is None:
+            results[post['post_id']] = None
+        elif 'envelope' in post:
+            results[post['post_id']] = decrypt_envelope(post['envelope'], data_key)
+        else:
+            results[post['post_id']] = decrypt_with_symmetric_key(post['encrypted_text'], data_key)
+    return results
+
+# A function that gets one page of posts from a specific user, newest first
+def get_user_posts(user_id, page_size=POSTS_PAGE_SIZE, cursor=None):
+    posts_ref = db.collection('posts')
+    return fetch_newest_page(posts_ref.where('user_id', '==', user_id), page_size, cursor)
+
+def get_excluded_user_ids(user_id):
+    # The user and everyone sharing a group with them, i.e. the audience of their posts
+    return set(read_audience(user_id)['members'])
+
+
+def get_recent_posts(limit=POSTS_PAGE_SIZE, exclude_user_ids=None, cursor=None, max_reads=EXPLORE_MAX_READS):
+    # Returns up to `limit` of the newest posts not written by exclude_user_ids, and a cursor
+    # to continue from (None once every post has been scanned). Excluded authors can't be
+    # filtered server-side: 'not-in' takes at most 10 values and would force the query to
+    # order by user_id instead of timestamp. So ordered pages are pulled until this one is
+    # full, bounded by max_reads.
     posts_ref = db.collection('posts')
-    recent_posts_query = posts_ref.order_by('timestamp', direction=firestore.Query.DESCENDING).limit(limit)
-    recent_posts = recent_posts_query.stream()
+    exclude_user_ids = exclude_user_ids or set()
 
     posts_list = []
-    for post in recent_posts:
-        post_data = post.to_dict()
-        post_data['post_id'] = post.id
-        
-        # Exclude posts by the current user and their group members
-        if exclude_user_ids and post_data['user_id'] not in exclude_user_ids:
-            posts_list.append(post_data)
+    reads = 0
+    while len(posts_list) < limit and reads < max_reads:
+        recent_posts, next_cursor = fetch_newest_page(posts_ref, EXPLORE_FETCH_SIZE, cursor)
+        reads += len(recent_posts)
+
+        for post_data in recent_posts:
+            # Exclude posts by the current user and their group members
+            if post_data['user_id'] not in exclude_user_ids:
+                posts_list.append(post_data)
+                if len(posts_list) == limit:
+                    # Page is full part-way through this batch; resume right after this post
+                    return posts_list, post_cursor(post_data)
+
+        cursor = next_cursor
+        if cursor is None:
+            break
 
-    return posts_list
+    return posts_list, cursor
 
-# A function that deletes a specific post
+# A function that deletes a specific post, along with its attachment chunks
 def delete_post(post_id):
     try:
-        db.collection('posts').document(post_id).delete()
+        post_ref = db.collection('posts').document(post_id)
+        post = post_ref.get().to_dict() or {}
+        for attachment in post.get('attachments', []):
+            delete_attachment(attachment)
+        post_ref.delete()
+        if 'user_id' in post:
+            invalidate_posts(get_excluded_user_ids(post['user_id']))
         st.success("Post deleted successfully.")
     except Exception as e:
-        st.error(f"An error occurred while deleting the post: {e}")
\ No newline at end of file
+        st.error(f"An error occurred while deleting the post: {e}")
@@ -0,0 +1,302 @@
+# Background re-encryption jobs for group membership changes.
+# Adding or removing a member changes the group and its keys immediately, but rewriting the
+# keys of the group's existing posts can take minutes for a large group. That part is queued
+# as a document in 'reencrypt_jobs' and processed on a worker pool here, so the admin's form
+# submit returns straight away. With STORAGE_BACKEND=memory the queue lives in the in-memory
+# store, so jobs run offline like everything else.
+#
+# A job walks its members' posts in document id order, JOB_BATCH_SIZE at a time. Each batch's
+# post updates are computed in parallel and written with BatchWriter, then the last post id
+# is checkpointed on the job, so an interrupted job resumes after its last checkpoint.
+# Rewritten posts are stamped with the job id (POST_JOB_FIELD) and skipped if seen again,
+# so redoing the batch that was in flight when a process died changes nothing.
+#
+# Jobs for the same group run one at a time in the order they were queued: each prepares
+# from the group as it is when it starts, so a job queued by an earlier membership change
+# can't overwrite posts after a later one (e.g. re-add a removed member's key).
+# A worker holds a job through a lease it renews at every checkpoint. start_job_resumer()
+# periodically picks up queued jobs and jobs whose worker stopped renewing its lease,
+# first checking one interval after it starts so app startup stays free of job queries.
+# Job kinds are registered by the module that knows how to update a post (group_utils):
+# prepare(job) loads what the job needs once, such as public keys, and
+# update_post(context, post_data) returns the update for one post or None.
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from feed_cache import invalidate_users
+from firestore_batch import BatchWriter, merge_sorted, query_where_in_slices
+from metrics import timed
+from storage import db, firestore
+
+logger = logging.getLogger(__name__)
+
+JOB_COLLECTION = 'reencrypt_jobs'
+
+# Posts read, updated and checkpointed together
+JOB_BATCH_SIZE = int(os.getenv('REENCRYPT_BATCH_SIZE', 200))
+
+# Jobs run at the same time per process, and posts of one batch updated in parallel
+JOB_WORKERS = int(os.getenv('REENCRYPT_JOB_WORKERS', 2))
+POST_WORKERS = int(os.getenv('REENCRYPT_POST_WORKERS', 8))
+
+# A running job whose lease hasn't been renewed for this long is taken over by another worker
+JOB_LEASE_SECONDS = int(os.getenv('REENCRYPT_LEASE_SECONDS', 120))
+
+# Field stamped on every post a job rewrites
+POST_JOB_FIELD = 'reencrypt_job'
+
+# Identifies this process in job leases
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+_job_kinds = {}
+_active_jobs = set()
+_resubmit_jobs = set()
+_executors = {}
+_executor_lock = threading.Lock()
+
+
+def register_job_kind(kind, prepare, update_post):
+    _job_kinds[kind] = (prepare, update_post)
+
+
+def _get_executor(name, max_workers):
+    # Separate pools: a job thread waits on its batch's post updates, and the post updates
+    # themselves use the key wrapping pool, so sharing either would risk starving it
+    with _executor_lock:
+        if name not in _executors:
+            _executors[name] = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f'reencrypt-{name}')
+        return _executors[name]
+
+
+def enqueue_job(kind, group_id, admin_id, members, user_id=None):
+    # Queue re-encryption of the members' posts and start it in the background; returns the job id
+    now = time.time()
+    _, job_ref = db.collection(JOB_COLLECTION).add({
+        'kind': kind,
+        'group_id': group_id,
+        'admin_id': admin_id,
+        'user_id': user_id,
+        'members': list(members),
+        'status': 'queued',
+        'cursor': None,
+        'processed': 0,
+        'updated': 0,
+        'batches': 0,
+        'error': None,
+        'worker': None,
+        'lease_expires': 0,
+        'created_at': now,
+        'started_at': None,
+        'updated_at': now,
+        'finished_at': None,
+    })
+    _submit(job_ref.id)
+    return job_ref.id
+
+
+def _submit(job_id):
+    with _executor_lock:
+        if job_id in _active_jobs:
+            # Asked again while it runs (or is waiting on the group's earlier job): try once more after
+            _resubmit_jobs.add(job_id)
+            return
+        _active_jobs.add(job_id)
+    _get_executor('jobs', JOB_WORKERS).submit(run_job, job_id)
+
+
+def _job_order(job_id, job):
+    return (job['created_at'], job_id)
+
+
+def _unfinished_group_jobs(group_id, transaction=None):
+    query = db.collection(JOB_COLLECTION).where('group_id', '==', group_id).where('status', 'in', ['queued', 'running'])
+    return query.get(transaction=transaction)
+
+
+def _claim(transaction, job_ref, now):
+    snapshot = job_ref.get(transaction=transaction)
+    if not snapshot.exists:
+        return None
+    job = snapshot.to_dict()
+    if job['status'] in ('done', 'failed'):
+        return None
+    if job['status'] == 'running' and job['worker'] != WORKER_ID and job['lease_expires'] > now:
+        return None  # Another worker is still making progress on it
+    if any(_job_order(other.id, other.to_dict()) < _job_order(job_ref.id, job)
+           for other in _unfinished_group_jobs(job['group_id'], transaction)):
+        return None  # Started by whoever finishes the group's earlier job
+    changes = {
+        'status': 'running',
+        'worker': WORKER_ID,
+        'lease_expires': now + JOB_LEASE_SECONDS,
+        'started_at': job['started_at'] or now,
+        'updated_at': now,
+    }
+    transaction.update(job_ref, changes)
+    job.update(changes)
+    return job
+
+
+def _checkpoint(transaction, job_ref, changes):
+    # Record progress only while this worker still holds the job; False if it was taken over
+    snapshot = job_ref.get(transaction=transaction)
+    if snapshot.to_dict().get('worker') != WORKER_ID:
+        return False
+    transaction.update(job_ref, changes)
+    return True
+
+
+def _record(job_ref, changes):
+    now = time.time()
+    changes = dict(changes, updated_at=now, lease_expires=now + JOB_LEASE_SECONDS)
+    return firestore.transactional(_checkpoint)(db.transaction(), job_ref, changes)
+
+
+def _next_posts(members, cursor, batch_size):
+    # The next batch_size posts by these members after the cursor, in document id order
+    def after_cursor(query):
+        query = query.order_by('__name__')
+        if cursor is not None:
+            query = query.start_after({'__name__': cursor})
+        return query.limit(batch_size)
+
+    slices = query_where_in_slices('posts', 'user_id', members, after_cursor)
+    return merge_sorted(slices, key=lambda snapshot: snapshot.id, limit=batch_size)
+
+
+def run_job(job_id):
+    job_ref = db.collection(JOB_COLLECTION).document(job_id)
+    job = None
+    try:
+        job = firestore.transactional(_claim)(db.transaction(), job_ref, time.time())
+        if job is None:
+            return
+        _run_claimed(job_id, job_ref, job)
+    except Exception as exc:
+        logger.exception("Re-encryption job %s failed", job_id)
+        _record(job_ref, {'status': 'failed', 'error': str(exc), 'finished_at': time.time()})
+    finally:
+        with _executor_lock:
+            _active_jobs.discard(job_id)
+            resubmit = job_id in _resubmit_jobs
+            _resubmit_jobs.discard(job_id)
+        if resubmit:
+            _submit(job_id)
+    if job is not None:
+        _start_next_group_job(job['group_id'])
+
+
+def _start_next_group_job(group_id):
+    # Hand the group over to its earliest waiting job
+    waiting = sorted(_unfinished_group_jobs(group_id), key=lambda snapshot: _job_order(snapshot.id, snapshot.to_dict()))
+    if waiting:
+        _submit(waiting[0].id)
+
+
+def _run_claimed(job_id, job_ref, job):
+    prepare, update_post = _job_kinds[job['kind']]
+    context = prepare(job)
+
+    def post_update(snapshot):
+        post_data = snapshot.to_dict()
+        if post_data.get(POST_JOB_FIELD) == job_id:
+            return None  # Rewritten before the last checkpoint was recorded
+        return update_post(context, post_data)
+
+    cursor, processed, updated, batches = job['cursor'], job['processed'], job['updated'], job['batches']
+    while True:
+        with timed('jobs.reencrypt_batch'):
+            snapshots = _next_posts(job['members'], cursor, JOB_BATCH_SIZE)
+            if not snapshots:
+                break
+            updates = list(_get_executor('posts', POST_WORKERS).map(post_update, snapshots))
+            with BatchWriter(f"reencrypt_job.{job['kind']}") as writer:
+                for snapshot, update in zip(snapshots, updates):
+                    if update is not None:
+                        writer.update(snapshot.reference, dict(update, **{POST_JOB_FIELD: job_id}))
+
+        cursor = snapshots[-1].id
+        processed += len(snapshots)
+        updated += writer.writes
+        batches += 1
+        if not _record(job_ref, {'cursor': cursor, 'processed': processed, 'updated': updated, 'batches': batches}):
+            logger.warning("Re-encryption job %s was taken over by another worker", job_id)
+            return
+
+    _record(job_ref, {'status': 'done', 'finished_at': time.time()})
+    invalidate_users(job['members'] + [job['admin_id']] + ([job['user_id']] if job['user_id'] else []))
+    logger.info("Re-encryption job %s finished: %d posts checked, %d updated", job_id, processed, updated)
+
+
+def retry_job(job_id):
+    # Put a failed job back in the queue; it resumes from its last checkpoint
+    db.collection(JOB_COLLECTION).document(job_id).update({'status': 'queued', 'error': None, 'finished_at': None})
+    _submit(job_id)
+
+
+def resume_jobs():
+    # Start queued jobs and take over running ones whose worker stopped renewing its lease
+    now = time.time()
+    jobs = db.collection(JOB_COLLECTION).where('status', 'in', ['queued', 'running']).get()
+    for snapshot in jobs:
+        job = snapshot.to_dict()
+        if job['status'] == 'queued' or job['lease_expires'] <= now:
+            _submit(snapshot.id)
+
+
+def list_jobs(admin_id, limit=10):
+    # The admin's most recent jobs, newest first; backed by the (admin_id, created_at DESC)
+    # index in firestore.indexes.json, so only `limit` jobs are read however many there were
+    query = db.collection(JOB_COLLECTION).where('admin_id', '==', admin_id) \
+              .order_by('created_at', direction=firestore.Query.DESCENDING).limit(limit)
+    return [dict(snapshot.to_dict(), job_id=snapshot.id) for snapshot in query.get()]
+
+
+def job_throughput(job):
+    # Posts checked per second since the job first started
+    if not job['started_at'] or not job['processed']:
+        return 0.0
+    elapsed = (job['finished_at'] or job['updated_at']) - job['started_at']
+    return job['processed'] / elapsed if elapsed > 0 else 0.0
+
+
+_resumer = None
+_resumer_stop = None
+_resumer_lock = threading.Lock()
+
+
+def start_job_resumer(interval=JOB_LEASE_SECONDS):
+    # Checks for jobs to resume every `interval` seconds; safe to call on every Streamlit rerun.
+    # The first check waits a full interval too, so starting the app queries nothing: jobs
+    # queued by this process start on their own, and an interrupted job's lease has to
+    # expire before it can be taken over anyway.
+    global _resumer, _resumer_stop
+    with _resumer_lock:
+        if _resumer is None:
+            stop = threading.Event()
+
+            def loop():
+                while not stop.wait(interval):
+                    try:
+                        resume_jobs()
+                    except Exception:
+                        logger.exception("Checking for re-encryption jobs to resume failed")
+            _resumer_stop = stop
+            _resumer = threading.Thread(target=loop, name='reencrypt-resumer', daemon=True)
+            _resumer.start()
+        return _resumer
+
+
+def stop_job_resumer(timeout=None):
+    # Stop the resumer after any check in progress; start_job_resumer() can start a new one
+    global _resumer, _resumer_stop
+    with _resumer_lock:
+        resumer, stop = _resumer, _resumer_stop
+        _resumer = _resumer_stop = None
+    if resumer is not None:
+        stop.set()
+        resumer.join(timeout)
@@ -0,0 +1,84 @@
+# Chooses the document store every module talks to through `db`.
+# STORAGE_BACKEND=firestore (the default) uses the Firebase project's Firestore;
+# STORAGE_BACKEND=memory uses the in-process stand-in in memory_store, which needs
+# no credentials or network. `firestore` is the matching module for field transforms
+# (ArrayUnion, ArrayRemove, DELETE_FIELD, SERVER_TIMESTAMP), Query directions and
+# firestore.transactional.
+# Unless METRICS_ENABLED=0, `db` is wrapped so every call is timed and its document
+# reads and writes are counted (see firestore_metrics).
+#
+# Nothing is imported or initialised until first use: importing the Firebase and
+# Firestore client libraries and building the client takes longer than rendering the
+# login page, so `db` and `firestore` are stand-ins that load the real objects the
+# first time an attribute is read.
+import os
+import threading
+from dotenv import load_dotenv
+
+load_dotenv()
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "firestore")
+
+if STORAGE_BACKEND not in ("firestore", "memory"):
+    raise ValueError(f"Unknown STORAGE_BACKEND: {STORAGE_BACKEND!r} (expected 'firestore' or 'memory')")
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_firestore_module():
+    if STORAGE_BACKEND == "memory":
+        import memory_store
+        return memory_store
+    from firebase_admin import firestore as firestore_module
+    return firestore_module
+
+
+def _create_client():
+    if STORAGE_BACKEND == "memory":
+        import memory_store
+        client = memory_store.MemoryClient()
+    else:
+        import firebase_admin
+        from firebase_admin import credentials
+
+        # Initialize Firebase Admin once
+        if not firebase_admin._apps:
+            cred = credentials.Certificate('firebase-admin.json')
+            firebase_admin.initialize_app(cred)
+
+        # Firestore database
+        client = get_firestore_module().client()
+
+    if os.getenv("METRICS_ENABLED", "1") != "0":
+        from firestore_metrics import instrument_client
+        client = instrument_client(client)
+    return client
+
+
+def get_client():
+    # The first caller builds the client; concurrent first callers wait for it instead of building their own
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = _create_client()
+    return _client
+
+
+def get_backend_client():
+    # The client without the metrics wrapper, for adapters that count their own reads and writes
+    client = get_client()
+    return getattr(client, '_target', client)
+
+
+class _Deferred:
+    # Forwards attribute access to an object that is only loaded on first use
+    def __init__(self, load):
+        self._load = load
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+
+db = _Deferred(get_client)
+firestore = _Deferred(get_firestore_module)
@@ -0,0 +1,60 @@
+# Tests run offline: the in-memory storage backend and a scratch keystore
+import os
+import sys
+import time
+
+os.environ["STORAGE_BACKEND"] = "memory"
+os.environ.setdefault("KEYSTORE_PASSPHRASE", "tests")
+os.environ["METRICS_PORT"] = "0"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+import streamlit as st
+from cryptography.hazmat.primitives.asymmetric import rsa
+from gen_keys import generate_key_pair
+from reencrypt_jobs import list_jobs
+from storage import db
+
+
+@pytest.fixture(scope="session", autouse=True)
+def scratch_dir(tmp_path_factory):
+    # The keystore is created under ./keys on first use
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp("work"))
+    yield
+    os.chdir(cwd)
+
+
+@pytest.fixture(autouse=True)
+def clean_store():
+    db.reset()
+    st.session_state.clear()
+    yield
+    st.session_state.clear()
+
+
+@pytest.fixture(scope="session")
+def private_keys():
+    # A few RSA keys shared by every test user; generating one per user would dominate the run
+    return [rsa.generate_private_key(public_exponent=65537, key_size=2048) for _ in range(4)]
+
+
+@pytest.fixture
+def add_user(private_keys):
+    created = []
+
+    def add(uid):
+        certificate = generate_key_pair(uid, private_key=private_keys[len(created) % len(private_keys)])
+        db.collection("users").document(uid).set({"username": uid, "email": f"{uid}@example.com", "certificate": certificate})
+        created.append(uid)
+        return uid
+    return add
+
+
+@pytest.fixture
+def wait_for_jobs():
+    # Blocks until none of the admin's re-encryption jobs is queued or running
+    def wait(admin_id):
+        while any(job['status'] in ('queued', 'running') for job in list_jobs(admin_id, limit=100)):
+            time.sleep(0.01)
+    return wait
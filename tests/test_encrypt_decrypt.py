@@ -0,0 +1,27 @@
+import os
+import keystore
+from encrypt_decrypt import load_private_key, private_key_path, store_private_key
+
+
+def public_numbers(private_key):
+    return private_key.public_key().public_numbers()
+
+
+def test_pem_files_without_keystore_passphrase(monkeypatch, private_keys):
+    monkeypatch.setattr(keystore, 'KEYSTORE_PASSPHRASE', None)
+    store_private_key('pem-user', private_keys[0])
+    assert os.path.exists(private_key_path('pem-user'))
+    assert public_numbers(load_private_key('pem-user')) == public_numbers(private_keys[0])
+
+    # Replacing the file is picked up despite the cached copy
+    os.remove(private_key_path('pem-user'))
+    store_private_key('pem-user', private_keys[1])
+    assert public_numbers(load_private_key('pem-user')) == public_numbers(private_keys[1])
+
+
+def test_keystore_takes_precedence_over_pem(private_keys):
+    store_private_key('both', private_keys[2])
+    assert not os.path.exists(private_key_path('both'))
+    with open(private_key_path('both'), 'wb') as f:
+        f.write(b'not read')
+    assert public_numbers(load_private_key('both')) == public_numbers(private_keys[2])
@@ -0,0 +1,30 @@
+import time
+import streamlit as st
+import feed_listener
+from feed_listener import FeedListener, close_idle_listeners
+from group_utils import add_user_to_group, create_group
+from pages import get_feed_listener
+from post_utils import create_post
+
+
+def test_idle_listeners_are_closed_and_replaced(add_user):
+    admin, member = add_user("admin"), add_user("member")
+    create_group("g", admin)
+    add_user_to_group("g", member, admin)
+    create_post(member, "hello")
+
+    active, abandoned = get_feed_listener(admin), FeedListener(member)
+    assert len(active.page()[0]) == 1
+    abandoned.last_used = time.monotonic() - 2 * feed_listener.FEED_LISTENER_IDLE_SECONDS
+
+    assert close_idle_listeners() == 1
+    assert abandoned.closed and not active.closed
+    assert abandoned not in feed_listener._listeners
+
+    # A session whose listener timed out gets a fresh one on its next rerun
+    active.last_used = time.monotonic() - 2 * feed_listener.FEED_LISTENER_IDLE_SECONDS
+    close_idle_listeners()
+    replacement = get_feed_listener(admin)
+    assert replacement is not active and st.session_state['feed_listener'] is replacement
+    assert len(replacement.page()[0]) == 1
+    replacement.close()
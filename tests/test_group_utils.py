@@ -0,0 +1,19 @@
+from group_utils import add_user_to_group, create_group, remove_user_from_group
+from storage import db
+
+
+def test_remove_rotates_epoch_without_touching_history(add_user, wait_for_jobs):
+    admin, member = add_user("admin"), add_user("member")
+    group_id = create_group("g", admin)
+    add_user_to_group("g", member, admin)
+    wait_for_jobs(admin)
+    before = db.collection('groups').document(group_id).get().to_dict()
+
+    remove_user_from_group("g", member, admin)
+    wait_for_jobs(admin)
+    after = db.collection('groups').document(group_id).get().to_dict()
+
+    assert after['epoch'] == before['epoch'] + 1
+    assert member not in after['epoch_keys'][str(after['epoch'])]
+    for epoch, wrapped_keys in before['epoch_keys'].items():
+        assert after['epoch_keys'][epoch] == wrapped_keys
@@ -0,0 +1,32 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from key_pool import KeyPairPool
+
+
+def test_unusable_executor_falls_back_to_inline_generation():
+    pool = KeyPairPool(size=2, workers=1)
+    broken = ThreadPoolExecutor(max_workers=1)
+    broken.shutdown()
+    pool._executor = broken
+
+    assert pool.take() is None
+    assert pool.metrics()['in_flight'] == 0
+    assert pool._executor is None  # Rebuilt on the next refill
+
+
+def test_refill_fills_to_target(monkeypatch):
+    pool = KeyPairPool(size=2, workers=1)
+    executor = ThreadPoolExecutor(max_workers=1)
+    monkeypatch.setattr(pool, '_ensure_executor', lambda: executor)
+    pool.refill()
+    executor.shutdown(wait=True)
+    assert pool.metrics()['depth'] == 2 and pool.metrics()['in_flight'] == 0
+    assert pool.take() is not None
+
+
+def test_cancelled_generation_is_not_counted():
+    pool = KeyPairPool(size=1, workers=1)
+    pool._in_flight = 1
+    future = Future()
+    future.cancel()
+    pool._on_generated(future)
+    assert pool.metrics()['in_flight'] == 0 and pool.metrics()['depth'] == 0
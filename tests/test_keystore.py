@@ -0,0 +1,67 @@
+import os
+import pytest
+import keystore as keystore_module
+from keystore import Keystore, key_entry_name
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'keystore.dat')
+
+
+def test_round_trip_and_newest_record_wins(path):
+    store = Keystore(path, 'pw')
+    first = store.put(key_entry_name('alice'), b'first')
+    store.put(key_entry_name('bob', 'x25519'), b'bob')
+    second = store.put(key_entry_name('alice'), b'second')
+    assert second > first
+    assert store.locate(key_entry_name('alice')) == second
+    assert store.read(key_entry_name('alice')) == b'second'
+    assert store.read(key_entry_name('carol')) is None
+    store.close()
+
+    reopened = Keystore(path, 'pw')
+    assert reopened.read(key_entry_name('alice')) == b'second'
+    assert reopened.read(key_entry_name('bob', 'x25519')) == b'bob'
+    assert sorted(reopened.names()) == ['alice/rsa', 'bob/x25519']
+    reopened.close()
+
+
+def test_records_are_bound_to_their_name(path):
+    store = Keystore(path, 'pw')
+    offset = store.put(key_entry_name('alice'), b'secret')
+    with pytest.raises(KeyError):
+        store.read_at(offset, key_entry_name('mallory'))
+    store.close()
+
+
+def test_torn_tail_is_ignored_then_truncated(path):
+    store = Keystore(path, 'pw')
+    store.put(key_entry_name('alice'), b'alice')
+    store.close()
+    intact_size = os.path.getsize(path)
+    with open(path, 'ab') as f:
+        f.write(b'\x00\x00\x01\x00\x00\x09bob/rs')  # A record cut short mid-append
+
+    store = Keystore(path, 'pw')
+    assert store.read(key_entry_name('alice')) == b'alice'
+    assert store.locate(key_entry_name('bob')) is None
+    offset = store.put(key_entry_name('bob'), b'bob')
+    assert offset == intact_size
+    assert store.read(key_entry_name('bob')) == b'bob'
+    store.close()
+
+    reopened = Keystore(path, 'pw')
+    assert sorted(reopened.names()) == ['alice/rsa', 'bob/rsa']
+    reopened.close()
+
+
+def test_wrong_passphrase_is_rejected(path):
+    Keystore(path, 'pw').close()
+    with pytest.raises(ValueError):
+        Keystore(path, 'not the passphrase')
+
+
+def test_no_keystore_without_passphrase(monkeypatch):
+    monkeypatch.setattr(keystore_module, 'KEYSTORE_PASSPHRASE', None)
+    assert keystore_module.get_keystore() is None
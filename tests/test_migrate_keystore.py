@@ -0,0 +1,41 @@
+import pytest
+from cryptography.hazmat.primitives import serialization
+import migrate_keystore
+from keystore import Keystore, key_entry_name
+
+
+def pem(private_key):
+    return private_key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption()
+    )
+
+
+@pytest.fixture
+def keystore(tmp_path, monkeypatch):
+    keystore = Keystore(str(tmp_path / 'keystore.dat'), 'tests')
+    monkeypatch.setattr(migrate_keystore, 'get_keystore', lambda: keystore)
+    yield keystore
+    keystore.close()
+
+
+def test_migrate_never_overwrites_stored_keys(keystore, private_keys, tmp_path):
+    keys_dir = tmp_path / 'keys'
+    keys_dir.mkdir()
+    for uid, private_key in (('fresh', private_keys[0]), ('rotated', private_keys[1]), ('same', private_keys[2])):
+        (keys_dir / f'{uid}_private_key.pem').write_bytes(pem(private_key))
+    current = migrate_keystore.pem_to_der(pem(private_keys[3]))
+    keystore.put(key_entry_name('rotated'), current)
+    keystore.put(key_entry_name('same'), migrate_keystore.pem_to_der(pem(private_keys[2])))
+
+    migrate_keystore.migrate(str(keys_dir), delete=True)
+
+    assert keystore.read(key_entry_name('fresh')) == migrate_keystore.pem_to_der(pem(private_keys[0]))
+    assert keystore.read(key_entry_name('rotated')) == current
+    assert sorted(path.name for path in keys_dir.iterdir()) == ['rotated_private_key.pem']
+
+    # Re-running changes nothing
+    migrate_keystore.migrate(str(keys_dir), delete=True)
+    assert keystore.read(key_entry_name('rotated')) == current
+    assert (keys_dir / 'rotated_private_key.pem').exists()
@@ -0,0 +1,40 @@
+import io
+import pytest
+import streamlit as st
+from attachments import iter_attachment
+from group_utils import add_user_to_group, create_group, remove_user_from_group
+from post_utils import create_post, decrypt_posts, get_user_posts, post_data_keys
+
+
+def test_author_reads_own_post_after_leaving_group(add_user, wait_for_jobs):
+    admin, author = add_user("admin"), add_user("author")
+    create_group("g", admin)
+    add_user_to_group("g", author, admin)
+    wait_for_jobs(admin)
+    create_post(author, "mine")
+
+    remove_user_from_group("g", author, admin)
+    wait_for_jobs(admin)
+    st.session_state.clear()
+
+    posts, _ = get_user_posts(author)
+    assert list(decrypt_posts(posts, author).values()) == ["mine"]
+
+
+@pytest.mark.parametrize('full_reencrypt', [False, True])
+def test_attachments_survive_resealing(add_user, full_reencrypt, wait_for_jobs):
+    admin, member = add_user("admin"), add_user("member")
+    payload = bytes(range(256)) * 1000
+    create_post(admin, "with attachment", [io.BytesIO(payload)])
+    create_group("g", admin)
+    add_user_to_group("g", member, admin, full_reencrypt=full_reencrypt)
+    wait_for_jobs(admin)
+    remove_user_from_group("g", member, admin)
+    wait_for_jobs(admin)
+    st.session_state.clear()
+
+    posts, _ = get_user_posts(admin)
+    [post] = posts
+    assert decrypt_posts(posts, admin) == {post['post_id']: "with attachment"}
+    [attachment] = post['attachments']
+    assert b''.join(iter_attachment(attachment, post_data_keys(posts, admin)[post['post_id']])) == payload
@@ -0,0 +1,121 @@
+import time
+import pytest
+import reencrypt_jobs
+from encrypt_decrypt import encrypt_for_group_members, key_id, open_envelope
+from firestore_batch import stream_where_in
+from group_utils import add_user_to_group, create_group, get_group_member_public_keys, member_wrapped_plaintext, remove_user_from_group
+from storage import db, firestore
+
+LEGACY_POSTS = 120
+
+
+@pytest.fixture
+def group(add_user, monkeypatch, wait_for_jobs):
+    # Small batches keep both jobs of a test in flight together for many checkpoints
+    monkeypatch.setattr(reencrypt_jobs, 'JOB_BATCH_SIZE', 5)
+    admin, member = add_user("admin"), add_user("member")
+    create_group("g", admin)
+    add_user_to_group("g", member, admin)
+    wait_for_jobs(admin)
+    public_keys = get_group_member_public_keys(admin)
+    for i in range(LEGACY_POSTS):
+        text, wrapped_keys = encrypt_for_group_members(public_keys, f"post {i}")
+        db.collection('posts').add({
+            'user_id': (admin, member)[i % 2], 'encrypted_text': text, 'encrypted_keys': wrapped_keys,
+            'timestamp': firestore.SERVER_TIMESTAMP,
+        })
+    return admin, member
+
+
+def holds_member_key(post_data, user_id):
+    if 'envelope' in post_data:
+        return key_id(user_id) in open_envelope(post_data['envelope']).member_entries
+    return user_id in post_data.get('encrypted_keys', {})
+
+
+def test_removal_is_not_undone_by_earlier_reseal(group, add_user, monkeypatch, wait_for_jobs):
+    admin, member = group
+    outsider = add_user("outsider")
+    prepare, update_post = reencrypt_jobs._job_kinds['reseal_members']
+
+    def slow_update_post(context, post_data):
+        # Keep the reseal that still includes the outsider behind the one queued after it
+        if outsider in context['member_keys']:
+            time.sleep(0.005)
+        return update_post(context, post_data)
+
+    monkeypatch.setitem(reencrypt_jobs._job_kinds, 'reseal_members', (prepare, slow_update_post))
+    add_user_to_group("g", outsider, admin, full_reencrypt=True)
+    while not reencrypt_jobs.list_jobs(admin, limit=1)[0]['batches']:
+        time.sleep(0.001)  # The reseal has read the member keys, outsider included
+    remove_user_from_group("g", outsider, admin)
+    wait_for_jobs(admin)
+
+    posts = stream_where_in('posts', 'user_id', [admin, member])
+    assert len(posts) == LEGACY_POSTS
+    assert not [post.id for post in posts if holds_member_key(post.to_dict(), outsider)]
+
+
+def test_grant_is_not_lost_to_earlier_reseal(group, add_user, wait_for_jobs):
+    admin, member = group
+    newcomer = add_user("newcomer")
+    remove_user_from_group("g", member, admin)
+    add_user_to_group("g", newcomer, admin)
+    wait_for_jobs(admin)
+
+    for post in stream_where_in('posts', 'user_id', [admin]):
+        post_data = post.to_dict()
+        assert not ('envelope' in post_data and 'encrypted_keys' in post_data)
+        assert member_wrapped_plaintext(post_data, newcomer) is not None
+        assert not holds_member_key(post_data, member)
+
+
+def test_job_resumes_after_failure_without_redoing_posts(group, add_user, monkeypatch, wait_for_jobs):
+    admin, _ = group
+    calls = []
+
+    def update_post(context, post_data):
+        calls.append(post_data)
+        if len(calls) == 23:
+            raise RuntimeError("worker died")
+        return {'touched': post_data.get('touched', 0) + 1}
+
+    reencrypt_jobs.register_job_kind('touch', lambda job: None, update_post)
+    job_id = reencrypt_jobs.enqueue_job('touch', 'g', admin, [admin])
+    wait_for_jobs(admin)
+    job = db.collection('reencrypt_jobs').document(job_id).get().to_dict()
+    assert job['status'] == 'failed' and job['processed'] < LEGACY_POSTS // 2
+
+    reencrypt_jobs.retry_job(job_id)
+    wait_for_jobs(admin)
+    job = db.collection('reencrypt_jobs').document(job_id).get().to_dict()
+    assert job['status'] == 'done' and job['processed'] == LEGACY_POSTS // 2
+    assert {post.to_dict()['touched'] for post in stream_where_in('posts', 'user_id', [admin])} == {1}
+
+
+@pytest.fixture
+def resumer_checks(monkeypatch):
+    checks = []
+    monkeypatch.setattr(reencrypt_jobs, 'resume_jobs', lambda: checks.append(time.time()))
+    yield checks
+    reencrypt_jobs.stop_job_resumer()
+
+
+def test_resumer_waits_an_interval_before_first_check(resumer_checks):
+    started = time.time()
+    resumer = reencrypt_jobs.start_job_resumer(interval=0.2)
+    assert resumer_checks == []
+    while not resumer_checks:
+        time.sleep(0.01)
+    assert resumer_checks[0] - started >= 0.2
+
+    reencrypt_jobs.stop_job_resumer()
+    assert not resumer.is_alive()
+    assert reencrypt_jobs.start_job_resumer(interval=0.2) is not resumer
+
+
+def test_list_jobs_reads_only_the_newest(monkeypatch):
+    monkeypatch.setattr(reencrypt_jobs, '_submit', lambda job_id: None)
+    job_ids = [reencrypt_jobs.enqueue_job('touch', 'g', 'admin', []) for _ in range(5)]
+    reencrypt_jobs.enqueue_job('touch', 'g', 'other admin', [])
+    assert [job['job_id'] for job in reencrypt_jobs.list_jobs('admin', limit=3)] == job_ids[:1:-1]